@@ -0,0 +1,117 @@
+import argparse
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+from m0wut_drivers.gpio import GPIO
+
+# Pin numbers are all the same width so the fake kernel can split the
+# numbers read back to back from the export FIFO
+FIRST_GPIO = 100
+POLL_INTERVAL = 100e-6
+
+
+class FakeSysfs:
+    """
+    Temporary directory standing in for /sys/class/gpio. A pin's directory
+    appears as soon as it is exported but its files only lag seconds later,
+    like udev fixing their permissions on real hardware. Missing files are
+    used rather than permissions because root ignores file modes. export is
+    a FIFO as every export writes at offset 0 of the file
+    """
+
+    def __init__(self, root: pathlib.Path, lag: float):
+        self.root = root
+        self.lag = lag
+        os.mkfifo(root / "export")
+        (root / "unexport").write_bytes(b"")
+        # Opened here so exporting doesn't block waiting for a reader
+        self._export_fd = os.open(root / "export", os.O_RDONLY | os.O_NONBLOCK)
+        self._pending: list[tuple[float, int]] = []
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._running = False
+        self._thread.join()
+        os.close(self._export_fd)
+
+    def _run(self) -> None:
+        width = len(str(FIRST_GPIO))
+        exported = b""
+        while self._running:
+            try:
+                exported += os.read(self._export_fd, 4096)
+            except BlockingIOError:
+                pass
+            while len(exported) >= width:
+                gpio = int(exported[:width])
+                exported = exported[width:]
+                pin = self.root / f"gpio{gpio}"
+                # The kernel creates the directory before the write to
+                # export returns, here it may be exported again before then
+                if not pin.exists():
+                    pin.mkdir()
+                    self._pending.append((time.monotonic() + self.lag, gpio))
+            now = time.monotonic()
+            for ready in [x for x in self._pending if x[0] <= now]:
+                self._pending.remove(ready)
+                pin = self.root / f"gpio{ready[1]}"
+                (pin / "value").write_bytes(b"0\n")
+                (pin / "direction").write_bytes(b"in\n")
+            time.sleep(POLL_INTERVAL)
+
+
+def one_at_a_time(gpios: list[int]) -> list[GPIO]:
+    return [GPIO(x, GPIO.INPUT) for x in gpios]
+
+
+def as_group(gpios: list[int]) -> list[GPIO]:
+    return GPIO.create_group(gpios, GPIO.INPUT)
+
+
+def measure(create, pins: int, lag: float) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        GPIO.SYSFS_ROOT = pathlib.Path(directory)
+        sysfs = FakeSysfs(GPIO.SYSFS_ROOT, lag)
+        try:
+            start = time.monotonic()
+            created = create(list(range(FIRST_GPIO, FIRST_GPIO + pins)))
+            elapsed = time.monotonic() - start
+            for pin in created:
+                # Close the descriptors without unexporting, the fake kernel
+                # doesn't remove pins
+                for fd in [pin._value_fd, pin._direction_fd]:
+                    os.close(fd)
+        finally:
+            sysfs.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the time to export GPIOs against a fake "
+        "sysfs tree whose pin files appear some time after export"
+    )
+    parser.add_argument("--pins", type=int, default=32)
+    parser.add_argument(
+        "--lag",
+        type=float,
+        default=0.05,
+        help="Seconds between exporting a pin and its files being usable",
+    )
+    args = parser.parse_args()
+    if not 0 < args.pins <= 900:
+        parser.error("--pins must be between 1 and 900")
+
+    methods = [("one at a time", one_at_a_time), ("group", as_group)]
+    for name, create in methods:
+        elapsed = measure(create, args.pins, args.lag)
+        print(f"{name:<15}{args.pins} pins in {elapsed * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import pathlib
+import tempfile
+import time
+
+from m0wut_drivers.gpio import GPIO
+from m0wut_drivers.histogram import LatencyHistogram
+
+# Files are regular files in a temporary directory standing in for
+# /sys/class/gpio, so this measures the Python and syscall overhead of each
+# access rather than the GPIO driver. Percentiles are LatencyHistogram
+# bucket limits, so up to a factor of two high
+ROW = "{:<22}{:>12}{:>10}{:>10}{:>10}"
+
+
+def make_sysfs(root: pathlib.Path, gpio: int) -> None:
+    (root / "export").write_text("")
+    (root / "unexport").write_text("")
+    pin = root / f"gpio{gpio}"
+    pin.mkdir()
+    (pin / "value").write_text("0\n")
+    (pin / "direction").write_text("in\n")
+
+
+def open_per_access_toggle(pin: GPIO, state: list[bool]) -> None:
+    """Toggle as it was done before the value file was kept open"""
+    state[0] = not state[0]
+    with open(pin.dir / "value", "w") as file:
+        file.write("1" if state[0] else "0")
+
+
+def measure(toggle, count: int) -> LatencyHistogram:
+    histogram = LatencyHistogram()
+    previous = time.perf_counter()
+    for _ in range(count):
+        toggle()
+        now = time.perf_counter()
+        histogram.record(now - previous)
+        previous = now
+    return histogram
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures GPIO toggle rate and jitter against a "
+        "temporary directory standing in for /sys/class/gpio"
+    )
+    parser.add_argument("--toggles", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        GPIO.SYSFS_ROOT = pathlib.Path(directory)
+        make_sysfs(GPIO.SYSFS_ROOT, 0)
+        with GPIO(0, GPIO.OUTPUT) as pin:
+            state = [False]
+            results = {
+                "open per access": measure(
+                    lambda: open_per_access_toggle(pin, state), args.toggles
+                ),
+                "persistent fd": measure(pin.toggle, args.toggles),
+            }
+
+    print(ROW.format("method", "toggles/s", "p50 us", "p99 us", "max us"))
+    for name, histogram in results.items():
+        print(
+            ROW.format(
+                name,
+                f"{histogram.count / histogram.total:.0f}",
+                f"{histogram.percentile(50) * 1e6:.1f}",
+                f"{histogram.percentile(99) * 1e6:.1f}",
+                f"{histogram.max * 1e6:.1f}",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
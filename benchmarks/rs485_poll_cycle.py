@@ -0,0 +1,112 @@
+import argparse
+import os
+import pathlib
+import threading
+import time
+import tty
+
+from m0wut_drivers.rs485_message_handler import MessageHandler, RS485Packet
+from m0wut_drivers.rs485_poller import RS485Poller
+
+# The master talks to simulated slaves over a pty pair, which has no wire
+# time, so cycle times are the poller's timeouts and the slaves' response
+# delay rather than bus throughput
+MASTER_ADDRESS = 0
+FIRST_ADDRESS = 1
+ROW = "{:<8}{:>10}{:>8}{:>10}"
+
+
+class NullTransceiverPin:
+    """Direction pin for MessageHandler, a pty doesn't need switching"""
+
+    def set_direction(self, direction) -> None:
+        pass
+
+    def write(self, value) -> None:
+        pass
+
+
+class SimulatedSlaves:
+    """
+    Answers text mode requests for the live addresses on the pty master
+    after delay seconds, echoing the payload. Requests for any other
+    address go unanswered, like a dead node
+    """
+
+    def __init__(self, fd: int, live: set[int], delay: float):
+        self.fd = fd
+        self.live = live
+        self.delay = delay
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        buffer = bytearray()
+        while True:
+            try:
+                buffer += os.read(self.fd, 4096)
+            except OSError:
+                # The other end of the pty was closed
+                return
+            while (end := buffer.find(b"\n")) != -1:
+                request = bytes(buffer[: end + 1])
+                del buffer[: end + 1]
+                if request[0] in self.live:
+                    time.sleep(self.delay)
+                    os.write(self.fd, bytes([MASTER_ADDRESS]) + request[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures RS485Poller cycle times against simulated "
+        "slaves on a pty pair, with some addresses not answering"
+    )
+    parser.add_argument("--live", type=int, default=3)
+    parser.add_argument("--dead", type=int, default=2)
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=1e-3,
+        help="Seconds a live slave takes to respond",
+    )
+    parser.add_argument("--baud", type=int, default=115200)
+    args = parser.parse_args()
+
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    tty.setraw(slave_fd)
+    addresses = list(
+        range(FIRST_ADDRESS, FIRST_ADDRESS + args.live + args.dead)
+    )
+    SimulatedSlaves(master_fd, set(addresses[: args.live]), args.delay)
+    handler = MessageHandler(
+        pathlib.Path(os.ttyname(slave_fd)),
+        args.baud,
+        NullTransceiverPin(),
+        MASTER_ADDRESS,
+    )
+    poller = RS485Poller(handler, addresses)
+
+    def make_packet(address: int) -> RS485Packet:
+        return RS485Packet(address=address, command="P", payload="ping")
+
+    print(ROW.format("cycle", "ms", "polled", "timeouts"))
+    with handler:
+        for cycle in range(args.cycles):
+            start = time.monotonic()
+            responses = poller.poll_cycle(make_packet)
+            elapsed = time.monotonic() - start
+            timeouts = sum(x is None for x in responses.values())
+            print(
+                ROW.format(
+                    cycle, f"{elapsed * 1e3:.1f}", len(responses), timeouts
+                )
+            )
+    handler.serial.close()
+    os.close(master_fd)
+    os.close(slave_fd)
+
+
+if __name__ == "__main__":
+    main()
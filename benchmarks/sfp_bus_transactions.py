@@ -0,0 +1,106 @@
+import argparse
+import time
+
+from m0wut_drivers.sfp import SFP
+
+# Each SMBus call or I2C_RDWR ioctl is one transaction, a round trip
+# through the kernel which dominates the time taken on real hardware
+ROW = "{:<10}{:>14}{:>10}{:>7}{:>10}"
+
+
+def make_eeprom() -> bytes:
+    page = bytearray(SFP.EEPROM_PAGE_LENGTH)
+    page[0:3] = bytes([3, 4, 7])
+    page[12] = 103
+    page[20:36] = b"M0WUT".ljust(16)
+    page[37:40] = bytes([0x00, 0x90, 0x65])
+    page[40:56] = b"SFP-10G-LR".ljust(16)
+    page[56:60] = b"A".ljust(4)
+    page[60:62] = (1310).to_bytes(2, "big")
+    page[68:84] = b"0123456789".ljust(16)
+    page[84:92] = b"26101600"
+    page[63] = sum(page[0:63]) & 0xFF
+    page[95] = sum(page[64:95]) & 0xFF
+    return bytes(page)
+
+
+class CountingSMBus:
+    """
+    Stand-in for smbus2.SMBus with one auto-incrementing byte addressed
+    memory, counting transactions, I2C messages and data bytes
+    """
+
+    def __init__(self, memory: bytes):
+        self.memory = bytearray(memory)
+        self.reset()
+
+    def reset(self) -> None:
+        self.transactions = 0
+        self.messages = 0
+        self.data_bytes = 0
+
+    def _count(self, messages: int, data_bytes: int) -> None:
+        self.transactions += 1
+        self.messages += messages
+        self.data_bytes += data_bytes
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        self._count(2, 1)
+        return self.memory[register]
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        self._count(2, length)
+        return list(self.memory[register : register + length])
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self._count(1, 1)
+        self.memory[register] = value
+
+    def i2c_rdwr(self, *messages):
+        pointer = 0
+        for message in messages:
+            if message.flags & 1:
+                data = self.memory[pointer : pointer + message.len]
+                for i, x in enumerate(data):
+                    message.buf[i] = x
+                pointer += message.len
+                self.data_bytes += message.len
+            else:
+                pointer = bytes(message)[0]
+        self.transactions += 1
+        self.messages += len(messages)
+
+    def close(self):
+        pass
+
+
+class PresentPin:
+    def read(self) -> bool:
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Counts the I2C bus transactions made by "
+        "SFP.read_sfp_info() against a fake SMBus"
+    )
+    parser.add_argument("--repeats", type=int, default=1000)
+    args = parser.parse_args()
+
+    bus = CountingSMBus(make_eeprom())
+    print(ROW.format("mode", "transactions", "messages", "bytes", "us/call"))
+    for bulk_read in (False, True):
+        sfp = SFP(bus, 0x50, gpio_present=PresentPin(), bulk_read=bulk_read)
+        bus.reset()
+        assert sfp.read_sfp_info() is not None
+        counts = (bus.transactions, bus.messages, bus.data_bytes)
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            sfp.read_sfp_info()
+        elapsed = (time.perf_counter() - start) / args.repeats
+        mode = "bulk" if bulk_read else "per-byte"
+        print(ROW.format(mode, *counts, f"{elapsed * 1e6:.1f}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from m0wut_drivers.i2c_device import I2CDevice
+
+
+class AsyncI2CBus:
+    """
+    Runs blocking driver calls for one I2C bus on a dedicated worker thread.
+    Calls on the same bus are executed in the order they were made, while
+    calls on different buses (each with their own AsyncI2CBus) run
+    concurrently
+    """
+
+    _buses: dict[int, AsyncI2CBus] = {}
+    _buses_lock = threading.Lock()
+
+    def __init__(self, bus: Any, timeout: Optional[float] = None):
+        """
+        If timeout is not None, calls that don't complete within timeout
+        seconds raise asyncio.TimeoutError
+        """
+        self.bus = bus
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="i2c"
+        )
+
+    @classmethod
+    def for_bus(cls, bus: Any, timeout: Optional[float] = None) -> AsyncI2CBus:
+        """Returns the shared AsyncI2CBus for bus, creating it if needed"""
+        with cls._buses_lock:
+            if id(bus) not in cls._buses:
+                cls._buses[id(bus)] = cls(bus, timeout=timeout)
+            return cls._buses[id(bus)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        with self._buses_lock:
+            if self._buses.get(id(self.bus)) is self:
+                del self._buses[id(self.bus)]
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(
+        self, function: Callable, *args, timeout: Optional[float] = None
+    ) -> Any:
+        """
+        Runs function(*args) on the bus's worker thread. Cancelling the
+        awaiting task (or timing out) before the call starts removes it from
+        the queue. A call that is already running can't be interrupted, so
+        a hung device will hold up later calls on the same bus, but never
+        the event loop or other buses
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, functools.partial(function, *args)
+        )
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+
+class AsyncDriver:
+    """
+    asyncio wrapper around a driver. Calling any method of the driver
+    through this returns a coroutine which runs the method on the driver's
+    AsyncI2CBus worker thread, e.g.
+
+        ina = AsyncDriver(INA3221(...))
+        reading = await ina.read_all()
+    """
+
+    def __init__(
+        self,
+        driver: Any,
+        bus: Optional[AsyncI2CBus] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.driver = driver
+        if bus is None:
+            bus = AsyncI2CBus.for_bus(self._find_bus(driver), timeout=timeout)
+        self.bus = bus
+        self.timeout = timeout
+
+    @staticmethod
+    def _find_bus(driver: Any) -> Any:
+        if isinstance(driver, I2CDevice):
+            return driver.bus
+        dev = getattr(driver, "dev", None)
+        if isinstance(dev, I2CDevice):
+            return dev.bus
+        raise ValueError(f"Unable to find the I2C bus used by {driver}")
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.driver, name)
+        if not callable(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            return await self.bus.run(
+                functools.partial(attribute, *args, **kwargs),
+                timeout=self.timeout,
+            )
+
+        return method
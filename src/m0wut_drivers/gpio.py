@@ -1,11 +1,20 @@
 # Standard imports
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
 import pathlib
+import select
+import threading
 import time
 from enum import Enum, auto
+from typing import Callable, Optional
 
 # Third-party imports
 
 # Local imports
+from m0wut_drivers.misc import GPIOExportTimeoutError
 
 
 class Polarity(Enum):
@@ -13,54 +22,191 @@ class Polarity(Enum):
     ACTIVE_LOW = 1
 
 
+class Edge(Enum):
+    """Logic level transitions which generate events, see GPIO.set_edge"""
+
+    NONE = "none"
+    RISING = "rising"
+    FALLING = "falling"
+    BOTH = "both"
+
+
 class GPIO:
     OUTPUT = 0
     INPUT = 1
     ASSERTED = 1
     DEASSERTED = 0
 
+    SYSFS_ROOT = pathlib.Path("/sys") / "class" / "gpio"
+    # Added to the pin number passed to the constructor by subclasses
+    BASE_ADDRESS = 0
+
+    # There is a processor dependent delay between writing a GPIO to export
+    # and its files being writable, so retry with exponential backoff
+    EXPORT_TIMEOUT = 5.0
+    EXPORT_INITIAL_BACKOFF = 1e-3
+    EXPORT_MAX_BACKOFF = 50e-3
+
+    # Pre-encoded values written to sysfs files, indexed by logic level
+    # and whether the pin is an output respectively
+    _LEVEL_BYTES = (b"0", b"1")
+    _DIRECTION_BYTES = {True: b"out", False: b"in"}
+    # epoll events signalling an edge on _edge_fd()
+    _EDGE_EVENTS = select.EPOLLPRI | select.EPOLLERR
+
     def __init__(
         self,
         gpio: int,
         direction: bool | int,
         polarity: Polarity = Polarity.ACTIVE_HIGH,
+        export_timeout: float = EXPORT_TIMEOUT,
     ):
-        """Base class for all GPIO pins"""
+        """
+        Base class for all GPIO pins. The sysfs value and direction files are
+        kept open for the lifetime of the object so each access is a single
+        pread / pwrite. Raises GPIOExportTimeoutError if the pin's files
+        aren't writable within export_timeout seconds of exporting it
+        """
         self.gpio = gpio
-        self.dir = pathlib.Path("/sys") / "class" / "gpio" / f"gpio{self.gpio}"
+        self.dir = self.SYSFS_ROOT / f"gpio{self.gpio}"
+        self._value_fd: int | None = None
+        self._direction_fd: int | None = None
+        # Watchers this pin has callbacks on, which must stop polling its
+        # file descriptor before it is closed
+        self._watchers: set[GPIOEdgeWatcher] = set()
 
         self.direction = direction
         self._value = self.DEASSERTED
         self.active_low: bool = bool(polarity == Polarity.ACTIVE_LOW)
 
-        if not self.dir.exists():
-            # Only export GPIO if it doesn't already exist
-            with open((self.dir.parent / "export"), "w") as file:
-                file.write(str(self.gpio))
+        self._export([self.gpio])
+        if not self._wait_until_writable(time.monotonic() + export_timeout):
+            if self._direction_fd is not None:
+                os.close(self._direction_fd)
+            raise GPIOExportTimeoutError([self.gpio])
 
-        # There is a processor dependant delay between writing a gpio to export
-        # and the folder being available to write to. This is a nasty hack but hey!
-        for i in range(5):
+    @classmethod
+    def _export(cls, gpios: list[int]) -> list[int]:
+        """
+        Exports any of gpios which aren't already exported and returns
+        those
+        """
+        gpios = [
+            x for x in gpios if not (cls.SYSFS_ROOT / f"gpio{x}").exists()
+        ]
+        if not gpios:
+            return gpios
+        fd = os.open(cls.SYSFS_ROOT / "export", os.O_WRONLY)
+        try:
+            for gpio in gpios:
+                os.write(fd, str(gpio).encode())
+        finally:
+            os.close(fd)
+        return gpios
+
+    @classmethod
+    def _unexport(cls, gpios: list[int]) -> None:
+        """Unexports gpios, ignoring any which aren't exported"""
+        if not gpios:
+            return
+        fd = os.open(cls.SYSFS_ROOT / "unexport", os.O_WRONLY)
+        try:
+            for gpio in gpios:
+                try:
+                    os.write(fd, str(gpio).encode())
+                except OSError:
+                    pass
+        finally:
+            os.close(fd)
+
+    def _wait_until_writable(self, deadline: float) -> bool:
+        """
+        Opens the pin's files and sets its direction, retrying until
+        deadline. Returns False on timeout
+        """
+        backoff = self.EXPORT_INITIAL_BACKOFF
+        while True:
             try:
                 self.set_direction(self.direction)
-            except PermissionError:
-                time.sleep(1)
-                assert i < 4, "Failed to write to GPIO file"
+                self._value_fd = os.open(self.dir / "value", os.O_RDWR)
+                return True
+            except (PermissionError, FileNotFoundError):
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(backoff)
+                backoff = min(2 * backoff, self.EXPORT_MAX_BACKOFF)
+
+    @classmethod
+    def create_group(
+        cls,
+        gpios: list[int],
+        direction: bool | int = INPUT,
+        polarity: Polarity = Polarity.ACTIVE_HIGH,
+        export_timeout: float = EXPORT_TIMEOUT,
+    ) -> list[GPIO]:
+        """
+        Creates several pins at once. All pins are exported in one pass
+        before waiting for any of them, so the export delays overlap rather
+        than adding up. gpios are numbered as for the class's constructor.
+        Raises GPIOExportTimeoutError listing every pin which timed out.
+        If any pin fails, the pins already created are closed and those
+        exported here are unexported again
+        """
+        exported = cls._export([x + cls.BASE_ADDRESS for x in gpios])
+        deadline = time.monotonic() + export_timeout
+        pins = []
+        failed = []
+        try:
+            for gpio in gpios:
+                try:
+                    pins.append(
+                        cls(
+                            gpio,
+                            direction=direction,
+                            polarity=polarity,
+                            export_timeout=max(
+                                0.0, deadline - time.monotonic()
+                            ),
+                        )
+                    )
+                except GPIOExportTimeoutError as e:
+                    failed += e.gpios
+            if failed:
+                raise GPIOExportTimeoutError(failed)
+        except BaseException:
+            # Closing a pin also unexports it
+            for pin in pins:
+                pin.__exit__()
+            opened = {pin.gpio for pin in pins}
+            cls._unexport([x for x in exported if x not in opened])
+            raise
+        return pins
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        if self.direction == GPIO.OUTPUT:
+        if self.direction == GPIO.OUTPUT and self._value_fd is not None:
             self.write(self.DEASSERTED)
-        with open((self.dir.parent / "unexport"), "w") as file:
+        self._remove_from_watchers()
+        for fd in [self._value_fd, self._direction_fd]:
+            if fd is not None:
+                os.close(fd)
+        self._value_fd = None
+        self._direction_fd = None
+        with open((self.SYSFS_ROOT / "unexport"), "w") as file:
             file.write(str(self.gpio))
 
     def set_direction(self, direction: bool | int) -> None:
         """Sets direction of GPIO pin"""
-        with open(self.dir / "direction", "w") as file:
-            file.write("out" if direction == GPIO.OUTPUT else "in")
-            self.direction = direction
+        if self._direction_fd is None:
+            self._direction_fd = os.open(self.dir / "direction", os.O_WRONLY)
+        os.pwrite(
+            self._direction_fd,
+            self._DIRECTION_BYTES[direction == GPIO.OUTPUT],
+            0,
+        )
+        self.direction = direction
 
     def write(self, value: bool | int) -> None:
         """
@@ -70,23 +216,242 @@ class GPIO:
         assert (
             self.direction == GPIO.OUTPUT
         ), f"Attempted to set state of GPIO {self.gpio} which is configured as an input"
-        with open(self.dir / "value", "w") as file:
-            file.write("1" if (value ^ self.active_low) else "0")
-            self._value = bool(value)
+        os.pwrite(
+            self._value_fd, self._LEVEL_BYTES[bool(value) ^ self.active_low], 0
+        )
+        self._value = bool(value)
 
     def read(self) -> bool:
         """
         Returns true if GPIO is asserted (not what logic level is on it)
         """
         if self.direction == GPIO.INPUT:
-            with open(self.dir / "value", "r") as file:
-                return bool(int(file.read().strip())) ^ self.active_low
+            level = os.pread(self._value_fd, 1, 0) == b"1"
+            return level ^ self.active_low
         else:
             return False
 
     def toggle(self) -> None:
         self.write(not self._value)
 
+    def read_asserted(self) -> bool:
+        """
+        Returns true if the pin is asserted, regardless of direction. Unlike
+        read(), outputs are read back rather than returning False
+        """
+        return (os.pread(self._value_fd, 1, 0) == b"1") ^ self.active_low
+
+    def set_edge(self, edge: Edge) -> None:
+        """
+        Selects which transitions of the pin generate edge events. Edges are
+        logic levels on the pin so, for an active low pin, assertion is a
+        falling edge
+        """
+        with open(self.dir / "edge", "w") as file:
+            file.write(edge.value)
+
+    def _edge_fd(self) -> int:
+        """File descriptor which GPIOEdgeWatcher polls for edge events"""
+        return self._value_fd
+
+    def _clear_edge_events(self) -> None:
+        """Discards any edge events which happened before now"""
+        os.pread(self._value_fd, 1, 0)
+
+    def _remove_from_watchers(self) -> None:
+        """Removes the pin's callbacks from every watcher"""
+        for watcher in list(self._watchers):
+            watcher.remove_gpio(self)
+
+    def _read_edge_event(self) -> Optional[tuple[int, bool]]:
+        """
+        Consumes an edge event from _edge_fd(). Returns the pin it was on
+        (as self.gpio) and its logic level afterwards, or None if there
+        wasn't one
+        """
+        return self.gpio, os.pread(self._value_fd, 1, 0) == b"1"
+
+    def add_edge_callback(
+        self,
+        callback: Callable[[GPIO, bool], None],
+        watcher: Optional[GPIOEdgeWatcher] = None,
+    ) -> None:
+        """
+        Calls callback(gpio, asserted) from the watcher thread after each
+        edge selected by set_edge()
+        """
+        (watcher or GPIOEdgeWatcher.default()).add_callback(self, callback)
+
+    def remove_edge_callback(
+        self,
+        callback: Callable[[GPIO, bool], None],
+        watcher: Optional[GPIOEdgeWatcher] = None,
+    ) -> None:
+        (watcher or GPIOEdgeWatcher.default()).remove_callback(self, callback)
+
+    async def wait_for_edge(
+        self,
+        timeout: Optional[float] = None,
+        watcher: Optional[GPIOEdgeWatcher] = None,
+    ) -> bool:
+        """
+        Waits for the next edge selected by set_edge() and returns whether
+        the pin is asserted afterwards. Raises asyncio.TimeoutError if no
+        edge occurs within timeout seconds
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(asserted: bool) -> None:
+            if not future.done():
+                future.set_result(asserted)
+
+        def callback(gpio: GPIO, asserted: bool) -> None:
+            loop.call_soon_threadsafe(set_result, asserted)
+
+        self.add_edge_callback(callback, watcher)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.remove_edge_callback(callback, watcher)
+
+
+class GPIOEdgeWatcher:
+    """
+    Waits for edge events on any number of GPIOs with a single epoll call
+    in one background thread, which is started when the first callback is
+    added
+    """
+
+    _default: Optional[GPIOEdgeWatcher] = None
+    _default_lock = threading.Lock()
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._epoll = select.epoll()
+        self._lock = threading.Lock()
+        # GPIOs with callbacks keyed by their edge file descriptor, which
+        # several lines of a character device request share
+        self._gpios: dict[int, list[GPIO]] = {}
+        self._callbacks: dict[GPIO, list[Callable[[GPIO, bool], None]]] = {}
+        # Written to in order to wake the thread up when stopping
+        self._wake_read, self._wake_write = os.pipe()
+        self._epoll.register(self._wake_read, select.EPOLLIN)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    @classmethod
+    def default(cls) -> GPIOEdgeWatcher:
+        """Returns a watcher shared by all GPIOs"""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def add_callback(
+        self, gpio: GPIO, callback: Callable[[GPIO, bool], None]
+    ) -> None:
+        fd = gpio._edge_fd()
+        with self._lock:
+            if fd not in self._gpios:
+                gpio._clear_edge_events()
+                self._gpios[fd] = []
+                self._epoll.register(fd, gpio._EDGE_EVENTS)
+            if gpio not in self._callbacks:
+                self._gpios[fd].append(gpio)
+                self._callbacks[gpio] = []
+                gpio._watchers.add(self)
+            self._callbacks[gpio].append(callback)
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(
+                    target=self._run, name="gpio-edge-watcher", daemon=True
+                )
+                self._thread.start()
+
+    def remove_callback(
+        self, gpio: GPIO, callback: Callable[[GPIO, bool], None]
+    ) -> None:
+        with self._lock:
+            callbacks = self._callbacks.get(gpio, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if gpio in self._callbacks and not callbacks:
+                self._remove(gpio)
+
+    def remove_gpio(self, gpio: GPIO) -> None:
+        """Removes all callbacks for gpio"""
+        with self._lock:
+            if gpio in self._callbacks:
+                self._remove(gpio)
+
+    def _remove(self, gpio: GPIO) -> None:
+        """Stops watching gpio. Must be called with self._lock held"""
+        del self._callbacks[gpio]
+        gpio._watchers.discard(self)
+        for fd, gpios in self._gpios.items():
+            if gpio in gpios:
+                gpios.remove(gpio)
+                if not gpios:
+                    self._epoll.unregister(fd)
+                    del self._gpios[fd]
+                return
+
+    def _run(self) -> None:
+        while self._running:
+            events = self._epoll.poll()
+            for fd, _ in events:
+                if fd == self._wake_read:
+                    os.read(fd, 1)
+                    continue
+                with self._lock:
+                    gpios = list(self._gpios.get(fd, []))
+                if not gpios:
+                    continue
+                event = gpios[0]._read_edge_event()
+                if event is None:
+                    continue
+                line, level = event
+                for gpio in gpios:
+                    if gpio.gpio == line:
+                        self._call(gpio, level ^ gpio.active_low)
+
+    def _call(self, gpio: GPIO, asserted: bool) -> None:
+        with self._lock:
+            callbacks = list(self._callbacks.get(gpio, []))
+        for callback in callbacks:
+            try:
+                callback(gpio, asserted)
+            except Exception:
+                self.logger.exception(
+                    f"Edge callback for GPIO {gpio.gpio} failed"
+                )
+
+    def close(self) -> None:
+        with self._lock:
+            thread = self._thread
+            self._running = False
+            self._thread = None
+            for gpio in self._callbacks:
+                gpio._watchers.discard(self)
+            self._callbacks.clear()
+            self._gpios.clear()
+        if thread is not None:
+            os.write(self._wake_write, b"\0")
+            thread.join()
+        self._epoll.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        with self._default_lock:
+            if GPIOEdgeWatcher._default is self:
+                GPIOEdgeWatcher._default = None
+
 
 class AxiGpio(GPIO):
 
@@ -97,11 +462,13 @@ class AxiGpio(GPIO):
         axiGpio: int,
         direction: bool | int = GPIO.INPUT,
         polarity=Polarity.ACTIVE_HIGH,
+        export_timeout: float = GPIO.EXPORT_TIMEOUT,
     ):
         super().__init__(
             gpio=axiGpio + self.BASE_ADDRESS,
             direction=direction,
             polarity=polarity,
+            export_timeout=export_timeout,
         )
 
 
@@ -114,11 +481,13 @@ class MIO(GPIO):
         mio: int,
         direction: bool | int = GPIO.INPUT,
         polarity=Polarity.ACTIVE_HIGH,
+        export_timeout: float = GPIO.EXPORT_TIMEOUT,
     ):
         super().__init__(
             gpio=mio + self.BASE_ADDRESS,
             direction=direction,
             polarity=polarity,
+            export_timeout=export_timeout,
         )
 
 
@@ -130,9 +499,11 @@ class RPiGPIO(GPIO):
         gpio: int,
         direction: bool | int = GPIO.INPUT,
         polarity=Polarity.ACTIVE_HIGH,
+        export_timeout: float = GPIO.EXPORT_TIMEOUT,
     ):
         super().__init__(
             gpio=gpio + self.BASE_ADDRESS,
             direction=direction,
             polarity=polarity,
+            export_timeout=export_timeout,
         )
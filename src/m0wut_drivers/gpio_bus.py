@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+# Standard imports
+from typing import Optional
+
+# Third-party imports
+
+# Local imports
+from m0wut_drivers.gpio import GPIO, Polarity
+from m0wut_drivers.gpio_cdev import GPIOLineRequest
+
+
+class GPIOBus:
+    """
+    Group of GPIOs driven as a single word, e.g. a parallel attenuator
+    control. Bit n of the word is pins[n]. Only pins whose bit has changed
+    since the last write are touched.
+
+    pins is either a list of GPIO objects, which each handle their own
+    polarity, or a GPIOLineRequest, in which case polarities gives the
+    polarity of each line and every write is a single ioctl so all lines
+    change at the same time
+    """
+
+    def __init__(
+        self,
+        pins: list[GPIO] | GPIOLineRequest,
+        polarities: Optional[list[Polarity]] = None,
+    ):
+        self.pins = pins
+        if isinstance(pins, GPIOLineRequest):
+            self.width = len(pins.offsets)
+            if polarities is None:
+                polarities = [Polarity.ACTIVE_HIGH] * self.width
+            if len(polarities) != self.width:
+                raise ValueError(
+                    f"Got {len(polarities)} polarities for {self.width} lines"
+                )
+            self._active_low_mask = sum(
+                1 << i
+                for i, polarity in enumerate(polarities)
+                if polarity == Polarity.ACTIVE_LOW
+            )
+        else:
+            if polarities is not None:
+                raise ValueError(
+                    "Polarity of GPIO objects is set when they are created"
+                )
+            self.width = len(pins)
+            self._active_low_mask = 0
+        self._mask = (1 << self.width) - 1
+        # Unknown until the first write, which then drives every pin
+        self._last_written: Optional[int] = None
+
+    @property
+    def last_written(self) -> Optional[int]:
+        return self._last_written
+
+    def write(self, word: int) -> None:
+        """Asserts the pins for bits set in word and deasserts the rest"""
+        if word & ~self._mask:
+            raise ValueError(
+                f"Value {hex(word)} does not fit in {self.width} bit bus"
+            )
+        if self._last_written is None:
+            changed = self._mask
+        else:
+            changed = word ^ self._last_written
+        if not changed:
+            return
+
+        if isinstance(self.pins, GPIOLineRequest):
+            self.pins.set_values(word ^ self._active_low_mask, mask=changed)
+        else:
+            for bit, pin in enumerate(self.pins):
+                if changed >> bit & 1:
+                    pin.write(word >> bit & 1)
+        self._last_written = word
+
+    def read(self) -> int:
+        """Returns a word with bits set for each pin which is asserted"""
+        if isinstance(self.pins, GPIOLineRequest):
+            return self.pins.get_values() ^ self._active_low_mask
+        return sum(
+            int(pin.read_asserted()) << bit
+            for bit, pin in enumerate(self.pins)
+        )
@@ -0,0 +1,585 @@
+from __future__ import annotations
+
+# Standard imports
+import ctypes
+import fcntl
+import os
+import pathlib
+import select
+from typing import Callable, Optional
+
+# Third-party imports
+
+# Local imports
+from m0wut_drivers.gpio import GPIO, Edge, Polarity
+from m0wut_drivers.misc import DeviceNotFoundError
+
+GPIO_MAX_NAME_SIZE = 32
+GPIO_V2_LINES_MAX = 64
+GPIO_V2_LINE_NUM_ATTRS_MAX = 10
+
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_OUTPUT = 1 << 3
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+
+GPIO_V2_LINE_ATTR_ID_FLAGS = 1
+GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 2
+
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+_EDGE_FLAGS = {
+    Edge.NONE: 0,
+    Edge.RISING: GPIO_V2_LINE_FLAG_EDGE_RISING,
+    Edge.FALLING: GPIO_V2_LINE_FLAG_EDGE_FALLING,
+    Edge.BOTH: GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EDGE_FALLING,
+}
+
+
+class GPIOChipInfo(ctypes.Structure):
+    _fields_ = [
+        ("name", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("label", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("lines", ctypes.c_uint32),
+    ]
+
+
+class GPIOV2LineValues(ctypes.Structure):
+    _fields_ = [("bits", ctypes.c_uint64), ("mask", ctypes.c_uint64)]
+
+
+class GPIOV2LineAttribute(ctypes.Structure):
+    # The kernel struct has a union of flags / values / debounce period,
+    # all of which fit in a u64
+    _fields_ = [
+        ("id", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32),
+        ("value", ctypes.c_uint64),
+    ]
+
+
+class GPIOV2LineConfigAttribute(ctypes.Structure):
+    _fields_ = [("attr", GPIOV2LineAttribute), ("mask", ctypes.c_uint64)]
+
+
+class GPIOV2LineConfig(ctypes.Structure):
+    _fields_ = [
+        ("flags", ctypes.c_uint64),
+        ("num_attrs", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32 * 5),
+        (
+            "attrs",
+            GPIOV2LineConfigAttribute * GPIO_V2_LINE_NUM_ATTRS_MAX,
+        ),
+    ]
+
+
+class GPIOV2LineRequest(ctypes.Structure):
+    _fields_ = [
+        ("offsets", ctypes.c_uint32 * GPIO_V2_LINES_MAX),
+        ("consumer", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("config", GPIOV2LineConfig),
+        ("num_lines", ctypes.c_uint32),
+        ("event_buffer_size", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32 * 5),
+        ("fd", ctypes.c_int32),
+    ]
+
+
+class GPIOV2LineEvent(ctypes.Structure):
+    _fields_ = [
+        ("timestamp_ns", ctypes.c_uint64),
+        ("id", ctypes.c_uint32),
+        ("offset", ctypes.c_uint32),
+        ("seqno", ctypes.c_uint32),
+        ("line_seqno", ctypes.c_uint32),
+        ("padding", ctypes.c_uint32 * 6),
+    ]
+
+
+class GPIOV2LineInfo(ctypes.Structure):
+    _fields_ = [
+        ("name", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("consumer", ctypes.c_char * GPIO_MAX_NAME_SIZE),
+        ("offset", ctypes.c_uint32),
+        ("num_attrs", ctypes.c_uint32),
+        ("flags", ctypes.c_uint64),
+        ("attrs", GPIOV2LineAttribute * GPIO_V2_LINE_NUM_ATTRS_MAX),
+        ("padding", ctypes.c_uint32 * 4),
+    ]
+
+
+def _iowr(number: int, structure: type, read_only: bool = False) -> int:
+    # _IOR / _IOWR from asm-generic/ioctl.h
+    direction = 2 if read_only else 3
+    return (
+        direction << 30 | ctypes.sizeof(structure) << 16 | 0xB4 << 8 | number
+    )
+
+
+GPIO_GET_CHIPINFO_IOCTL = _iowr(0x01, GPIOChipInfo, read_only=True)
+GPIO_V2_GET_LINEINFO_IOCTL = _iowr(0x05, GPIOV2LineInfo)
+GPIO_V2_GET_LINE_IOCTL = _iowr(0x07, GPIOV2LineRequest)
+GPIO_V2_LINE_SET_CONFIG_IOCTL = _iowr(0x0D, GPIOV2LineConfig)
+GPIO_V2_LINE_GET_VALUES_IOCTL = _iowr(0x0E, GPIOV2LineValues)
+GPIO_V2_LINE_SET_VALUES_IOCTL = _iowr(0x0F, GPIOV2LineValues)
+
+# Signature of fcntl.ioctl, which can be replaced for testing
+IoctlFunction = Callable[[int, int, ctypes.Structure], int]
+
+
+def _direction_flags(direction: bool | int) -> int:
+    if direction == GPIO.OUTPUT:
+        return GPIO_V2_LINE_FLAG_OUTPUT
+    return GPIO_V2_LINE_FLAG_INPUT
+
+
+class GPIOChip:
+    """
+    GPIO character device (/dev/gpiochipN), using the v2 uAPI. Unlike
+    sysfs, lines are addressed by chip and offset (or name) and several
+    lines of a chip can be read or written with a single ioctl. The ioctl
+    function can be replaced, e.g. with a stand-in for testing
+    """
+
+    DEV_ROOT = pathlib.Path("/dev")
+
+    def __init__(
+        self,
+        chip: int | str | pathlib.Path,
+        ioctl: IoctlFunction = fcntl.ioctl,
+    ):
+        """
+        chip is either the chip number (N in /dev/gpiochipN) or a path to
+        the character device
+        """
+        if isinstance(chip, int):
+            chip = self.DEV_ROOT / f"gpiochip{chip}"
+        self.path = pathlib.Path(chip)
+        self.ioctl = ioctl
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CLOEXEC)
+        except FileNotFoundError:
+            raise DeviceNotFoundError(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def get_info(self) -> GPIOChipInfo:
+        info = GPIOChipInfo()
+        self.ioctl(self.fd, GPIO_GET_CHIPINFO_IOCTL, info)
+        return info
+
+    def get_line_info(self, offset: int) -> GPIOV2LineInfo:
+        info = GPIOV2LineInfo(offset=offset)
+        self.ioctl(self.fd, GPIO_V2_GET_LINEINFO_IOCTL, info)
+        return info
+
+    def find_line(self, name: str) -> Optional[int]:
+        """Returns the offset of the line called name, or None"""
+        encoded_name = name.encode()
+        for offset in range(self.get_info().lines):
+            if self.get_line_info(offset).name == encoded_name:
+                return offset
+        return None
+
+    @classmethod
+    def find_line_by_name(
+        cls, name: str, ioctl: IoctlFunction = fcntl.ioctl
+    ) -> tuple[pathlib.Path, int]:
+        """Searches all chips for a line, returns (chip path, offset)"""
+        for path in sorted(cls.DEV_ROOT.glob("gpiochip*")):
+            with cls(path, ioctl=ioctl) as chip:
+                offset = chip.find_line(name)
+            if offset is not None:
+                return path, offset
+        raise DeviceNotFoundError(f"GPIO line {name}")
+
+    def request_lines(
+        self,
+        offsets: list[int],
+        direction: bool | int,
+        output_values: int = 0,
+        consumer: str = "m0wut_drivers",
+    ) -> GPIOLineRequest:
+        return GPIOLineRequest(
+            chip=self,
+            offsets=offsets,
+            direction=direction,
+            output_values=output_values,
+            consumer=consumer,
+        )
+
+
+class GPIOLineRequest:
+    """
+    A group of lines on one chip which are read and written together. Values
+    are integers where bit n is the logic level of offsets[n]. Methods which
+    take a mask only affect the lines whose bits are set in it
+    """
+
+    def __init__(
+        self,
+        chip: GPIOChip,
+        offsets: list[int],
+        direction: bool | int,
+        output_values: int = 0,
+        consumer: str = "m0wut_drivers",
+    ):
+        if not 0 < len(offsets) <= GPIO_V2_LINES_MAX:
+            raise ValueError(
+                f"Can request between 1 and {GPIO_V2_LINES_MAX} lines, "
+                f"got {len(offsets)}"
+            )
+        self.chip = chip
+        self.offsets = list(offsets)
+        self.direction = direction
+        self._all_lines = (1 << len(self.offsets)) - 1
+        # Flags of each line and the last values driven on outputs, which
+        # are needed to reconfigure some lines without disturbing the rest
+        self._line_flags = [_direction_flags(direction)] * len(self.offsets)
+        self._output_values = output_values
+        # Number of CdevGPIO pins sharing the request
+        self._users = 0
+
+        request = GPIOV2LineRequest()
+        for i, offset in enumerate(self.offsets):
+            request.offsets[i] = offset
+        request.consumer = consumer.encode()[: GPIO_MAX_NAME_SIZE - 1]
+        request.num_lines = len(self.offsets)
+        self._fill_config(request.config)
+        chip.ioctl(chip.fd, GPIO_V2_GET_LINE_IOCTL, request)
+        self.fd: Optional[int] = request.fd
+        # Edge events are read without blocking, see read_event()
+        os.set_blocking(self.fd, False)
+        # Reused for every get / set to avoid allocating per access
+        self._values = GPIOV2LineValues()
+        self._event = GPIOV2LineEvent()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _fill_config(self, config: GPIOV2LineConfig) -> None:
+        # Lines whose flags differ from the first line's get a flags
+        # attribute, shared between lines with the same flags
+        config.flags = self._line_flags[0]
+        attributes: dict[int, int] = {}
+        outputs = 0
+        for i, flags in enumerate(self._line_flags):
+            if flags != config.flags:
+                attributes[flags] = attributes.get(flags, 0) | 1 << i
+            if flags & GPIO_V2_LINE_FLAG_OUTPUT:
+                outputs |= 1 << i
+        attributes = [
+            (GPIO_V2_LINE_ATTR_ID_FLAGS, flags, mask)
+            for flags, mask in attributes.items()
+        ]
+        if outputs:
+            attributes.append(
+                (
+                    GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES,
+                    self._output_values,
+                    outputs,
+                )
+            )
+        if len(attributes) > GPIO_V2_LINE_NUM_ATTRS_MAX:
+            raise ValueError("Too many different line configurations")
+        for attribute, (id, value, mask) in zip(config.attrs, attributes):
+            attribute.attr.id = id
+            attribute.attr.value = value
+            attribute.mask = mask
+        config.num_attrs = len(attributes)
+
+    def _set_line_flags(self, line_flags: list[int]) -> None:
+        old_flags = self._line_flags
+        self._line_flags = line_flags
+        config = GPIOV2LineConfig()
+        try:
+            self._fill_config(config)
+            self.chip.ioctl(self.fd, GPIO_V2_LINE_SET_CONFIG_IOCTL, config)
+        except Exception:
+            self._line_flags = old_flags
+            raise
+
+    def set_direction(
+        self,
+        direction: bool | int,
+        output_values: int = 0,
+        mask: Optional[int] = None,
+    ) -> None:
+        """
+        Changes the direction of the lines selected by mask (default all).
+        Edge detection is turned off for lines changed to outputs and kept
+        for the rest
+        """
+        mask = self._all_lines if mask is None else mask
+        self._output_values = self._output_values & ~mask | (
+            output_values & mask
+        )
+        flags = _direction_flags(direction)
+        if direction != GPIO.OUTPUT:
+            edge_flags = _EDGE_FLAGS[Edge.BOTH]
+        else:
+            edge_flags = 0
+        self._set_line_flags(
+            [
+                flags | x & edge_flags if mask >> i & 1 else x
+                for i, x in enumerate(self._line_flags)
+            ]
+        )
+        if mask == self._all_lines:
+            self.direction = direction
+
+    def set_edge(self, edge: Edge, mask: Optional[int] = None) -> None:
+        """
+        Selects which transitions of the input lines selected by mask
+        (default all) generate events, see read_event()
+        """
+        mask = self._all_lines if mask is None else mask
+        for i, flags in enumerate(self._line_flags):
+            if mask >> i & 1 and not flags & GPIO_V2_LINE_FLAG_INPUT:
+                raise ValueError(
+                    f"Edge events need line {self.offsets[i]} to be an input"
+                )
+        flags = GPIO_V2_LINE_FLAG_INPUT | _EDGE_FLAGS[edge]
+        self._set_line_flags(
+            [
+                flags if mask >> i & 1 else x
+                for i, x in enumerate(self._line_flags)
+            ]
+        )
+
+    def read_event(self) -> Optional[GPIOV2LineEvent]:
+        """
+        Returns the next edge event or None if there isn't one. The event
+        object is reused by the next call
+        """
+        try:
+            length = os.readv(self.fd, [self._event])
+        except BlockingIOError:
+            return None
+        if length != ctypes.sizeof(GPIOV2LineEvent):
+            return None
+        return self._event
+
+    def get_values(self, mask: Optional[int] = None) -> int:
+        """Reads the lines selected by mask (default all) in one ioctl"""
+        self._values.mask = self._all_lines if mask is None else mask
+        self._values.bits = 0
+        self.chip.ioctl(self.fd, GPIO_V2_LINE_GET_VALUES_IOCTL, self._values)
+        return self._values.bits
+
+    def set_values(self, bits: int, mask: Optional[int] = None) -> None:
+        """Drives the lines selected by mask (default all) in one ioctl"""
+        mask = self._all_lines if mask is None else mask
+        self._values.mask = mask
+        self._values.bits = bits
+        self.chip.ioctl(self.fd, GPIO_V2_LINE_SET_VALUES_IOCTL, self._values)
+        self._output_values = self._output_values & ~mask | (bits & mask)
+
+
+class CdevGPIO(GPIO):
+    """
+    Single GPIO line on the character device backend, with the same API as
+    the sysfs GPIO class. The line is addressed by chip and offset, or by
+    name (in which case all chips are searched). Pins made by
+    create_group() share one request for all their lines
+    """
+
+    _EDGE_EVENTS = select.EPOLLIN
+
+    def __init__(
+        self,
+        line: int | str,
+        direction: bool | int = GPIO.INPUT,
+        polarity: Polarity = Polarity.ACTIVE_HIGH,
+        chip: Optional[GPIOChip | int | str | pathlib.Path] = None,
+        ioctl: IoctlFunction = fcntl.ioctl,
+    ):
+        chip, owns_chip, [line] = self._find_lines([line], chip, ioctl)
+        active_low = polarity == Polarity.ACTIVE_LOW
+        try:
+            request = chip.request_lines(
+                [line], direction, output_values=int(active_low)
+            )
+        except Exception:
+            if owns_chip:
+                chip.close()
+            raise
+        self._attach(chip, owns_chip, request, 0, direction, active_low)
+
+    @staticmethod
+    def _find_lines(
+        lines: list[int | str],
+        chip: Optional[GPIOChip | int | str | pathlib.Path],
+        ioctl: IoctlFunction,
+    ) -> tuple[GPIOChip, bool, list[int]]:
+        """
+        Resolves lines to offsets on one chip. Returns the chip, whether it
+        was opened here and the offsets
+        """
+        if chip is None:
+            if not all(isinstance(line, str) for line in lines):
+                raise ValueError(
+                    "A chip must be given when addressing by offset"
+                )
+            found = [
+                GPIOChip.find_line_by_name(line, ioctl=ioctl)
+                for line in lines
+            ]
+            paths = {path for path, _ in found}
+            if len(paths) > 1:
+                raise ValueError(f"Lines {lines} are on more than one chip")
+            chip = paths.pop()
+            lines = [offset for _, offset in found]
+        owns_chip = not isinstance(chip, GPIOChip)
+        if owns_chip:
+            chip = GPIOChip(chip, ioctl=ioctl)
+        offsets = []
+        for line in lines:
+            if isinstance(line, str):
+                offset = chip.find_line(line)
+                if offset is None:
+                    if owns_chip:
+                        chip.close()
+                    raise DeviceNotFoundError(
+                        f"GPIO line {line} on {chip.path}"
+                    )
+                line = offset
+            offsets.append(line)
+        return chip, owns_chip, offsets
+
+    def _attach(
+        self,
+        chip: GPIOChip,
+        owns_chip: bool,
+        request: GPIOLineRequest,
+        index: int,
+        direction: bool | int,
+        active_low: bool,
+    ) -> None:
+        self.chip = chip
+        self._owns_chip = owns_chip
+        self.request = request
+        self.gpio = request.offsets[index]
+        self._index = index
+        self._mask = 1 << index
+        self.dir = None
+        self._value_fd = None
+        self._direction_fd = None
+        self._watchers = set()
+        self.direction = direction
+        self._value = self.DEASSERTED
+        self.active_low: bool = active_low
+        # The last pin sharing the request closes it
+        request._users += 1
+
+    @classmethod
+    def create_group(
+        cls,
+        gpios: list[int | str],
+        direction: bool | int = GPIO.INPUT,
+        polarity: Polarity = Polarity.ACTIVE_HIGH,
+        export_timeout: float = GPIO.EXPORT_TIMEOUT,
+        chip: Optional[GPIOChip | int | str | pathlib.Path] = None,
+        ioctl: IoctlFunction = fcntl.ioctl,
+    ) -> list[CdevGPIO]:
+        """
+        Creates several pins on one chip with a single line request, so
+        there is one ioctl and one file descriptor for the whole group.
+        gpios are offsets or line names as for the constructor.
+        export_timeout is unused: character device lines are usable as
+        soon as they are requested
+        """
+        chip, owns_chip, offsets = cls._find_lines(gpios, chip, ioctl)
+        active_low = polarity == Polarity.ACTIVE_LOW
+        try:
+            request = chip.request_lines(
+                offsets,
+                direction,
+                output_values=(1 << len(offsets)) - 1 if active_low else 0,
+            )
+        finally:
+            # The request doesn't need the chip to stay open
+            if owns_chip:
+                chip.close()
+        pins = []
+        for index in range(len(offsets)):
+            pin = cls.__new__(cls)
+            pin._attach(chip, False, request, index, direction, active_low)
+            pins.append(pin)
+        return pins
+
+    def __exit__(self, *args, **kwargs):
+        if self.request.fd is None:
+            return
+        if self.direction == GPIO.OUTPUT:
+            self.write(self.DEASSERTED)
+        self._remove_from_watchers()
+        self.request._users -= 1
+        if self.request._users == 0:
+            self.request.close()
+            if self._owns_chip:
+                self.chip.close()
+
+    def set_direction(self, direction: bool | int) -> None:
+        level = int(bool(self._value) ^ self.active_low)
+        self.request.set_direction(
+            direction, output_values=level << self._index, mask=self._mask
+        )
+        self.direction = direction
+
+    def write(self, value: bool | int) -> None:
+        assert (
+            self.direction == GPIO.OUTPUT
+        ), f"Attempted to set state of GPIO {self.gpio} which is configured as an input"
+        level = int(bool(value) ^ self.active_low)
+        self.request.set_values(level << self._index, mask=self._mask)
+        self._value = bool(value)
+
+    def read_asserted(self) -> bool:
+        return bool(self.request.get_values(self._mask)) ^ self.active_low
+
+    def read(self) -> bool:
+        if self.direction == GPIO.INPUT:
+            return self.read_asserted()
+        else:
+            return False
+
+    def set_edge(self, edge: Edge) -> None:
+        """
+        Selects which transitions of the line generate edge events, which
+        are read from the request's file descriptor. As with sysfs, edges
+        are logic levels on the pin
+        """
+        self.request.set_edge(edge, mask=self._mask)
+
+    def _edge_fd(self) -> int:
+        return self.request.fd
+
+    def _clear_edge_events(self) -> None:
+        while self.request.read_event() is not None:
+            pass
+
+    def _read_edge_event(self) -> Optional[tuple[int, bool]]:
+        event = self.request.read_event()
+        if event is None:
+            return None
+        return event.offset, event.id == GPIO_V2_LINE_EVENT_RISING_EDGE
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import math
+import statistics
+import threading
+from array import array
+from dataclasses import dataclass
+from itertools import compress, repeat
+from operator import and_, le, mul, sub
+from typing import Optional
+
+from m0wut_drivers.ring_buffer import RingBuffer
+
+# Mean Earth radius in metres, for converting small lat/lon offsets to
+# local north/east distances
+EARTH_RADIUS = 6371008.8
+
+
+@dataclass(frozen=True)
+class GPSErrorEllipse:
+    # Semi-axes in metres at the requested confidence
+    semi_major: float
+    semi_minor: float
+    # Bearing of the major axis in degrees clockwise from north (0 to 180)
+    orientation: float
+    confidence: float
+
+
+@dataclass(frozen=True)
+class GPSErrorEllipsoid:
+    # Semi-axes in metres at the requested confidence, largest first
+    semi_axes: tuple[float, float, float]
+    confidence: float
+
+
+@dataclass(frozen=True)
+class GPSSurveyStatus:
+    samples: int
+    # Seconds between the first and last fix used
+    duration: float
+    # 3D standard deviation of the fixes in metres
+    accuracy: float
+    position: tuple[float, float, float]
+    complete: bool
+
+
+def _chi2_cdf(x: float, dof: int) -> float:
+    if dof == 1:
+        return math.erf(math.sqrt(x / 2))
+    if dof == 2:
+        return 1 - math.exp(-x / 2)
+    if dof == 3:
+        return math.erf(math.sqrt(x / 2)) - math.sqrt(
+            2 * x / math.pi
+        ) * math.exp(-x / 2)
+    raise ValueError(f"Unsupported degrees of freedom {dof}")
+
+
+def _chi2_quantile(probability: float, dof: int) -> float:
+    if not 0 < probability < 1:
+        raise ValueError(f"Invalid confidence {probability}")
+    low, high = 0.0, 1.0
+    while _chi2_cdf(high, dof) < probability:
+        high *= 2
+    for _ in range(60):
+        mid = (low + high) / 2
+        if _chi2_cdf(mid, dof) < probability:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+def _mean(values: array) -> float:
+    return math.fsum(values) / len(values)
+
+
+def _scaled_offsets(values: array, offset: float, scale: float) -> array:
+    """(values - offset) * scale"""
+    offsets = map(sub, values, repeat(offset))
+    return array("d", map(mul, offsets, repeat(scale)))
+
+
+def _covariance(x: array, x_mean: float, y: array, y_mean: float) -> float:
+    dx = map(sub, x, repeat(x_mean))
+    dy = map(sub, y, repeat(y_mean))
+    return math.fsum(map(mul, dx, dy)) / len(x)
+
+
+def _symmetric_eigenvalues(
+    a11: float, a22: float, a33: float, a12: float, a13: float, a23: float
+) -> tuple[float, float, float]:
+    """Eigenvalues of a symmetric 3x3 matrix, largest first"""
+    p1 = a12 * a12 + a13 * a13 + a23 * a23
+    if p1 == 0:
+        return tuple(sorted((a11, a22, a33), reverse=True))
+    q = (a11 + a22 + a33) / 3
+    p = math.sqrt(
+        ((a11 - q) ** 2 + (a22 - q) ** 2 + (a33 - q) ** 2 + 2 * p1) / 6
+    )
+    b11, b22, b33 = (a11 - q) / p, (a22 - q) / p, (a33 - q) / p
+    b12, b13, b23 = a12 / p, a13 / p, a23 / p
+    det = (
+        b11 * (b22 * b33 - b23 * b23)
+        - b12 * (b12 * b33 - b23 * b13)
+        + b13 * (b12 * b23 - b22 * b13)
+    )
+    phi = math.acos(max(-1.0, min(1.0, det / 2))) / 3
+    largest = q + 2 * p * math.cos(phi)
+    smallest = q + 2 * p * math.cos(phi + 2 * math.pi / 3)
+    return (largest, 3 * q - largest - smallest, smallest)
+
+
+class GPSHistory:
+    """
+    Bounded history of GPS fixes in a RingBuffer, so long surveys use
+    constant memory, with statistics for position surveys. Columns are
+    time (Unix seconds), lat, lon (degrees), alt (metres, NaN without a 3D
+    fix), sats and mode (gpsd fix mode: 0 no value, 1 no fix, 2 2D, 3 3D).
+
+    Statistics run over array columns with builtins (math.fsum, map,
+    itertools.compress) rather than Python loops. Distances use a local
+    flat earth approximation about the mean position, which is accurate to
+    well under a millimetre over the spread of a static survey
+    """
+
+    COLUMNS = ("time", "lat", "lon", "alt", "sats", "mode")
+
+    def __init__(self, capacity: int = 86400):
+        self._buffer = RingBuffer(self.COLUMNS, capacity)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def append(
+        self,
+        timestamp: float,
+        lat: float,
+        lon: float,
+        alt: float,
+        sats: int,
+        mode: int,
+    ) -> None:
+        with self._lock:
+            self._buffer.append((timestamp, lat, lon, alt, sats, mode))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buffer.clear()
+
+    def as_dict(self) -> dict[str, array]:
+        with self._lock:
+            return self._buffer.as_dict()
+
+    def _fixes(self, min_mode: int) -> dict[str, array]:
+        """
+        Columns for the samples with at least min_mode and a finite
+        position. gpsd reports without a value store NaN, and alt is only
+        required to be finite for 3D
+        """
+        data = self.as_dict()
+        selected = map(le, repeat(min_mode), data["mode"])
+        required = ("lat", "lon", "alt") if min_mode >= 3 else ("lat", "lon")
+        for name in required:
+            selected = map(and_, selected, map(math.isfinite, data[name]))
+        selected = list(selected)
+        return {
+            name: array("d", compress(column, selected))
+            for name, column in data.items()
+        }
+
+    def fix_availability(self, min_mode: int = 2) -> Optional[float]:
+        """Percentage of samples with at least min_mode"""
+        with self._lock:
+            modes = self._buffer.column("mode")
+        if not modes:
+            return None
+        return 100 * sum(map(le, repeat(min_mode), modes)) / len(modes)
+
+    @staticmethod
+    def _local_offsets(fixes: dict[str, array]) -> tuple[array, array]:
+        """
+        Returns each fix's north and east offset from the mean position in
+        metres
+        """
+        lat_mean = _mean(fixes["lat"])
+        lon_mean = _mean(fixes["lon"])
+        lat_scale = math.radians(EARTH_RADIUS)
+        lon_scale = lat_scale * math.cos(math.radians(lat_mean))
+        return (
+            _scaled_offsets(fixes["lat"], lat_mean, lat_scale),
+            _scaled_offsets(fixes["lon"], lon_mean, lon_scale),
+        )
+
+    @staticmethod
+    def _mean_position(
+        fixes: dict[str, array], vertical: bool
+    ) -> tuple[float, ...]:
+        position = (_mean(fixes["lat"]), _mean(fixes["lon"]))
+        if vertical:
+            position += (_mean(fixes["alt"]),)
+        return position
+
+    def mean_position(self, min_mode: int = 3) -> Optional[tuple[float, ...]]:
+        """
+        Mean (lat, lon, alt) of fixes with at least min_mode, or (lat, lon)
+        for 2D. None if there are no fixes
+        """
+        fixes = self._fixes(min_mode)
+        if not fixes["lat"]:
+            return None
+        return self._mean_position(fixes, min_mode >= 3)
+
+    def median_position(
+        self, min_mode: int = 3
+    ) -> Optional[tuple[float, ...]]:
+        """Per axis median of fixes, in the same form as mean_position()"""
+        fixes = self._fixes(min_mode)
+        if not fixes["lat"]:
+            return None
+        position = (
+            statistics.median(fixes["lat"]),
+            statistics.median(fixes["lon"]),
+        )
+        if min_mode >= 3:
+            position += (statistics.median(fixes["alt"]),)
+        return position
+
+    def _std_dev(
+        self, fixes: dict[str, array], vertical: bool
+    ) -> tuple[float, ...]:
+        """Standard deviation in metres (north, east[, up])"""
+        north, east = self._local_offsets(fixes)
+        result = (
+            math.sqrt(_covariance(north, 0.0, north, 0.0)),
+            math.sqrt(_covariance(east, 0.0, east, 0.0)),
+        )
+        if vertical:
+            alt = fixes["alt"]
+            alt_mean = _mean(alt)
+            result += (math.sqrt(_covariance(alt, alt_mean, alt, alt_mean)),)
+        return result
+
+    def std_dev(self, min_mode: int = 3) -> Optional[tuple[float, ...]]:
+        """
+        Standard deviation of fixes in metres (north, east, up), or
+        (north, east) for 2D
+        """
+        fixes = self._fixes(min_mode)
+        if not fixes["lat"]:
+            return None
+        return self._std_dev(fixes, min_mode >= 3)
+
+    def error_ellipse(
+        self, confidence: float = 0.95, min_mode: int = 2
+    ) -> Optional[GPSErrorEllipse]:
+        """Horizontal error ellipse of fixes at the given confidence"""
+        fixes = self._fixes(min_mode)
+        if len(fixes["lat"]) < 2:
+            return None
+        north, east = self._local_offsets(fixes)
+        var_n = _covariance(north, 0.0, north, 0.0)
+        var_e = _covariance(east, 0.0, east, 0.0)
+        cov_ne = _covariance(north, 0.0, east, 0.0)
+        centre = (var_n + var_e) / 2
+        radius = math.hypot((var_n - var_e) / 2, cov_ne)
+        scale = _chi2_quantile(confidence, 2)
+        # Angle of the major axis from north towards east
+        orientation = math.degrees(
+            0.5 * math.atan2(2 * cov_ne, var_n - var_e)
+        )
+        return GPSErrorEllipse(
+            semi_major=math.sqrt(scale * (centre + radius)),
+            semi_minor=math.sqrt(scale * max(0.0, centre - radius)),
+            orientation=orientation % 180,
+            confidence=confidence,
+        )
+
+    def error_ellipsoid(
+        self, confidence: float = 0.95
+    ) -> Optional[GPSErrorEllipsoid]:
+        """3D error ellipsoid of 3D fixes at the given confidence"""
+        fixes = self._fixes(3)
+        if len(fixes["lat"]) < 2:
+            return None
+        north, east = self._local_offsets(fixes)
+        up = fixes["alt"]
+        up_mean = _mean(up)
+        eigenvalues = _symmetric_eigenvalues(
+            _covariance(north, 0.0, north, 0.0),
+            _covariance(east, 0.0, east, 0.0),
+            _covariance(up, up_mean, up, up_mean),
+            _covariance(north, 0.0, east, 0.0),
+            _covariance(north, 0.0, up, up_mean),
+            _covariance(east, 0.0, up, up_mean),
+        )
+        scale = _chi2_quantile(confidence, 3)
+        return GPSErrorEllipsoid(
+            semi_axes=tuple(
+                math.sqrt(scale * max(0.0, x)) for x in eigenvalues
+            ),
+            confidence=confidence,
+        )
+
+    def survey_status(
+        self, min_duration: float, max_accuracy: float
+    ) -> Optional[GPSSurveyStatus]:
+        """
+        Progress of a survey-in over the 3D fixes in the history. It is
+        complete once the fixes span at least min_duration seconds and
+        their 3D standard deviation is no more than max_accuracy metres
+        """
+        fixes = self._fixes(3)
+        samples = len(fixes["lat"])
+        if samples == 0:
+            return None
+        duration = fixes["time"][-1] - fixes["time"][0]
+        accuracy = math.hypot(*self._std_dev(fixes, True))
+        position = self._mean_position(fixes, True)
+        return GPSSurveyStatus(
+            samples=samples,
+            duration=duration,
+            accuracy=accuracy,
+            position=position,
+            complete=duration >= min_duration and accuracy <= max_accuracy,
+        )
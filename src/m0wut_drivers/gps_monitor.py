@@ -1,9 +1,18 @@
 import gpsd
+import json
+import math
+import logging
+import socket
+import threading
+import time
 from datetime import datetime
 from dataclasses import dataclass
+from typing import Optional
 
 from enum import Enum
 
+from m0wut_drivers.gps_history import GPSHistory
+
 
 class GPSFixStatus(Enum):
     NO_VALUE = 0
@@ -20,34 +29,228 @@ class GPSInfo:
     time: datetime
 
 
+def _number(value: Optional[float]) -> float:
+    """Report field as a float, NaN if missing or null"""
+    return math.nan if value is None else float(value)
+
+
+class GPSWatcher:
+    """
+    Keeps one ?WATCH connection open to gpsd and parses the TPV, SKY and
+    PPS reports it streams on a background thread, caching the latest of
+    each. Reconnects if the connection is lost. If history is given, every
+    TPV report is added to it
+    """
+
+    WATCH_COMMAND = b'?WATCH={"enable":true,"json":true,"pps":true};\n'
+    RECONNECT_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 2947,
+        history: Optional[GPSHistory] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.history = history
+        self.logger = logging.getLogger(__name__)
+        self._condition = threading.Condition()
+        self._tpv: Optional[dict] = None
+        self._sky: dict = {}
+        self._pps: Optional[dict] = None
+        self._packet = gpsd.GpsResponse()
+        # time.monotonic() at which the last TPV and PPS reports arrived
+        self._tpv_time: Optional[float] = None
+        self._pps_time: Optional[float] = None
+        self._updates = 0
+        self._socket: Optional[socket.socket] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="GPSWatcher", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        sock = self._socket
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                with socket.create_connection(
+                    (self.host, self.port)
+                ) as self._socket:
+                    self._socket.sendall(self.WATCH_COMMAND)
+                    with self._socket.makefile("rb") as stream:
+                        for line in stream:
+                            try:
+                                self._handle_report(line)
+                            except Exception:
+                                # A bad report mustn't stop the thread
+                                self.logger.exception(
+                                    f"Failed to handle gpsd report {line!r}"
+                                )
+            except OSError as e:
+                if not self._stop.is_set():
+                    self.logger.warning(f"gpsd connection failed: {e}")
+            finally:
+                self._socket = None
+            self._stop.wait(self.RECONNECT_INTERVAL)
+
+    def _handle_report(self, line: bytes) -> None:
+        try:
+            report = json.loads(line)
+        except ValueError:
+            return
+        report_class = report.get("class")
+        if report_class not in ("TPV", "SKY", "PPS"):
+            return
+        now = time.monotonic()
+        with self._condition:
+            tpv = report if report_class == "TPV" else self._tpv
+            sky = report if report_class == "SKY" else self._sky
+            packet = self._packet
+            if tpv is not None and report_class != "PPS":
+                # Raises on a malformed report, which then isn't cached
+                packet = gpsd.GpsResponse.from_json(
+                    {"active": 1, "tpv": [tpv], "sky": [sky]}
+                )
+            if report_class == "TPV":
+                self._tpv = report
+                self._tpv_time = now
+            elif report_class == "SKY":
+                self._sky = report
+            else:
+                self._pps = report
+                self._pps_time = now
+            self._packet = packet
+            self._updates += 1
+            self._condition.notify_all()
+        if report_class == "TPV" and self.history is not None:
+            # gpsd can send null for fields it has no value for
+            self.history.append(
+                time.time(),
+                _number(report.get("lat")),
+                _number(report.get("lon")),
+                _number(report.get("alt")),
+                self._packet.sats_valid,
+                report.get("mode") or 0,
+            )
+
+    def get_current(self) -> gpsd.GpsResponse:
+        """Latest state in the same form as gpsd.get_current()"""
+        with self._condition:
+            return self._packet
+
+    def get_age(self) -> Optional[float]:
+        """Seconds since the last TPV report, None if there hasn't been one"""
+        with self._condition:
+            if self._tpv_time is None:
+                return None
+            return time.monotonic() - self._tpv_time
+
+    def get_pps_offset(self) -> Optional[float]:
+        """
+        Offset in seconds of the system clock from the last PPS edge, None
+        if no PPS has been reported
+        """
+        with self._condition:
+            pps = self._pps
+        if pps is None:
+            return None
+        return (pps["clock_sec"] - pps["real_sec"]) + (
+            pps["clock_nsec"] - pps["real_nsec"]
+        ) * 1e-9
+
+    def wait_for_update(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the next report to be received. Returns False on timeout
+        """
+        with self._condition:
+            updates = self._updates
+            return self._condition.wait_for(
+                lambda: self._updates != updates, timeout
+            )
+
+
 class GPSMonitor:
-    def __init__(self, host: str = "127.0.0.1", port: int = 2947) -> None:
-        gpsd.connect(host, port)
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 2947,
+        watch: bool = False,
+        history_length: Optional[int] = None,
+    ) -> None:
+        """
+        By default each getter queries gpsd. If watch is True, a GPSWatcher
+        streams reports from gpsd and getters return its cached state
+        without any round trip.
+
+        If history_length is given, up to that many fixes are kept in
+        self.history, a GPSHistory. In watch mode every fix is recorded,
+        otherwise fixes are recorded by calling record_fix()
+        """
+        self.history: Optional[GPSHistory] = None
+        if history_length is not None:
+            self.history = GPSHistory(history_length)
+        self.watcher: Optional[GPSWatcher] = None
+        if watch:
+            self.watcher = GPSWatcher(host, port, self.history)
+        else:
+            gpsd.connect(host, port)
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        pass
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def get_current(self) -> gpsd.GpsResponse:
+        if self.watcher is not None:
+            return self.watcher.get_current()
+        return gpsd.get_current()
+
+    def get_age(self) -> Optional[float]:
+        """
+        Seconds since the cached fix was received (watch mode only, 0 when
+        querying gpsd directly)
+        """
+        if self.watcher is not None:
+            return self.watcher.get_age()
+        return 0.0
+
+    def wait_for_update(self, timeout: Optional[float] = None) -> bool:
+        """Waits for gpsd to report something new (watch mode only)"""
+        if self.watcher is None:
+            raise RuntimeError("wait_for_update() requires watch mode")
+        return self.watcher.wait_for_update(timeout)
 
     def get_number_of_sats(self) -> int:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return packet.sats
 
     def get_position(self) -> tuple[float, float]:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return packet.position()
 
     def get_altitude(self) -> float:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return packet.altitude()
 
     def get_time(self) -> datetime:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return packet.get_time()
 
     def get_info(self) -> GPSInfo:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return GPSInfo(
             num_sats=packet.sats,
             position=packet.position(),
@@ -55,8 +258,22 @@ class GPSMonitor:
             time=packet.get_time(),
         )
 
+    def record_fix(self) -> None:
+        """Adds the current fix to self.history"""
+        if self.history is None:
+            raise RuntimeError("GPSMonitor was created without a history")
+        packet = self.get_current()
+        self.history.append(
+            time.time(),
+            packet.lat if packet.mode >= 2 else math.nan,
+            packet.lon if packet.mode >= 2 else math.nan,
+            packet.alt if packet.mode >= 3 else math.nan,
+            packet.sats_valid,
+            packet.mode,
+        )
+
     def get_fix_status(self) -> GPSFixStatus:
-        packet = gpsd.get_current()
+        packet = self.get_current()
         return_value = {
             0: GPSFixStatus.NO_VALUE,
             1: GPSFixStatus.NO_FIX,
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from array import array
+from typing import Optional
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with power of two bucket widths, cheap enough to
+    record into from timing critical paths. Bucket 0 counts durations under
+    RESOLUTION, bucket n those from RESOLUTION * 2**(n - 1) up to
+    RESOLUTION * 2**n and the last bucket everything longer
+    """
+
+    RESOLUTION = 1e-6
+    BUCKETS = 24
+
+    def __init__(self):
+        self.counts = array("L", bytes(self.BUCKETS * array("L").itemsize))
+        self.count = 0
+        self.total = 0.0
+        self.max: Optional[float] = None
+
+    def record(self, seconds: float) -> None:
+        ticks = int(seconds / self.RESOLUTION)
+        bucket = ticks.bit_length() if ticks > 0 else 0
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def clear(self) -> None:
+        for i in range(self.BUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def bucket_limits(self) -> list[float]:
+        """Upper limit of each bucket in seconds (the last is unbounded)"""
+        return [self.RESOLUTION * 2**i for i in range(self.BUCKETS - 1)] + [
+            float("inf")
+        ]
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Upper limit of the bucket containing the given percentile, so an
+        overestimate of at most a factor of two
+        """
+        if not self.count:
+            return None
+        target = self.count * percent / 100
+        seen = 0
+        for limit, count in zip(self.bucket_limits(), self.counts):
+            seen += count
+            if seen >= target:
+                return min(limit, self.max)
+        return self.max
+
+    def as_dict(self) -> dict[float, int]:
+        """Bucket upper limit -> count, for non-empty buckets"""
+        return {
+            limit: count
+            for limit, count in zip(self.bucket_limits(), self.counts)
+            if count
+        }
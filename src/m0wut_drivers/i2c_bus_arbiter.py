@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import functools
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Iterator, Optional
+
+import smbus2
+
+
+class I2CPriority(IntEnum):
+    """Lower values are granted the bus first"""
+
+    CRITICAL = 0
+    HIGH = 1
+    NORMAL = 2
+    BULK = 3
+
+
+@dataclass
+class I2CBusStatistics:
+    transactions: int = 0
+    total_wait_time: float = 0.0  # s
+    max_wait_time: float = 0.0  # s
+    occupancy_time: float = 0.0  # s, time spent holding the bus
+
+
+@dataclass
+class _Waiter:
+    priority: int
+    enqueue_time: float
+    sequence: int
+
+
+class I2CBusArbiter:
+    """
+    Shares one SMBus between drivers running in different threads. It can
+    be passed to drivers in place of the bus: every smbus2.SMBus transfer
+    method (those taking an i2c_addr, plus i2c_rdwr) claims the bus for its
+    duration, and other attributes are forwarded to the bus unchanged.
+
+    When several threads are waiting, the bus goes to the one with the
+    highest priority, which is set per device address with set_priority().
+    To stop a busy high priority device starving everything else, a
+    waiter's priority improves by one level for every aging_time seconds it
+    has been waiting. Waiters of equal priority are served in arrival order
+    """
+
+    # smbus2.SMBus methods whose first argument is the device address,
+    # other than those wrapped explicitly below
+    _ADDRESSED_METHODS = frozenset(
+        [
+            "write_quick",
+            "read_byte",
+            "write_byte",
+            "read_word_data",
+            "write_word_data",
+            "process_call",
+            "read_block_data",
+            "write_block_data",
+            "block_process_call",
+        ]
+    )
+
+    def __init__(self, bus: smbus2.SMBus, aging_time: float = 0.05):
+        self.bus = bus
+        self.aging_time = aging_time
+        self._condition = threading.Condition()
+        self._owner: Optional[int] = None
+        self._depth = 0
+        self._claim_time = 0.0
+        self._claim_addr: Optional[int] = None
+        self._waiters: list[_Waiter] = []
+        self._sequence = itertools.count()
+        self._priorities: dict[int, I2CPriority] = {}
+        self._statistics: dict[int, I2CBusStatistics] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def set_priority(self, i2c_addr: int, priority: I2CPriority) -> None:
+        self._priorities[i2c_addr] = priority
+
+    def get_statistics(self) -> dict[int, I2CBusStatistics]:
+        """Returns a copy of the statistics for each device address"""
+        with self._condition:
+            return {
+                addr: I2CBusStatistics(**vars(stats))
+                for addr, stats in self._statistics.items()
+            }
+
+    def _next_waiter(self) -> _Waiter:
+        now = time.monotonic()
+        return min(
+            self._waiters,
+            key=lambda x: (
+                x.priority - (now - x.enqueue_time) / self.aging_time,
+                x.sequence,
+            ),
+        )
+
+    def _acquire(self, i2c_addr: int, priority: Optional[int]) -> None:
+        thread = threading.get_ident()
+        with self._condition:
+            if self._owner == thread:
+                # Nested claim, e.g. a single read inside a locked sequence
+                self._depth += 1
+                return
+            if priority is None:
+                priority = self._priorities.get(i2c_addr, I2CPriority.NORMAL)
+            waiter = _Waiter(
+                priority=priority,
+                enqueue_time=time.monotonic(),
+                sequence=next(self._sequence),
+            )
+            self._waiters.append(waiter)
+            while (
+                self._owner is not None or self._next_waiter() is not waiter
+            ):
+                self._condition.wait()
+            self._waiters.remove(waiter)
+            self._owner = thread
+            self._depth = 1
+            self._claim_time = time.monotonic()
+            self._claim_addr = i2c_addr
+
+            wait_time = self._claim_time - waiter.enqueue_time
+            stats = self._statistics.setdefault(i2c_addr, I2CBusStatistics())
+            stats.transactions += 1
+            stats.total_wait_time += wait_time
+            stats.max_wait_time = max(stats.max_wait_time, wait_time)
+
+    def _release(self) -> None:
+        with self._condition:
+            self._depth -= 1
+            if self._depth:
+                return
+            stats = self._statistics[self._claim_addr]
+            stats.occupancy_time += time.monotonic() - self._claim_time
+            self._owner = None
+            self._claim_addr = None
+            self._condition.notify_all()
+
+    @contextmanager
+    def claim(
+        self, i2c_addr: int, priority: Optional[I2CPriority] = None
+    ) -> Iterator[None]:
+        """
+        Holds the bus for a sequence of accesses which mustn't be
+        interleaved with other devices' traffic. Claims can be nested within
+        the same thread. If priority is None, the device's priority from
+        set_priority() is used
+        """
+        self._acquire(i2c_addr, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def read_byte_data(
+        self, i2c_addr: int, register: int, force: Optional[bool] = None
+    ) -> int:
+        with self.claim(i2c_addr):
+            return self.bus.read_byte_data(i2c_addr, register, force=force)
+
+    def write_byte_data(
+        self,
+        i2c_addr: int,
+        register: int,
+        value: int,
+        force: Optional[bool] = None,
+    ) -> None:
+        with self.claim(i2c_addr):
+            self.bus.write_byte_data(i2c_addr, register, value, force=force)
+
+    def read_i2c_block_data(
+        self,
+        i2c_addr: int,
+        register: int,
+        length: int,
+        force: Optional[bool] = None,
+    ) -> list[int]:
+        with self.claim(i2c_addr):
+            return self.bus.read_i2c_block_data(
+                i2c_addr, register, length, force=force
+            )
+
+    def write_i2c_block_data(
+        self,
+        i2c_addr: int,
+        register: int,
+        data: list[int],
+        force: Optional[bool] = None,
+    ) -> None:
+        with self.claim(i2c_addr):
+            self.bus.write_i2c_block_data(
+                i2c_addr, register, data, force=force
+            )
+
+    def i2c_rdwr(self, *i2c_msgs: smbus2.i2c_msg) -> None:
+        with self.claim(i2c_msgs[0].addr):
+            self.bus.i2c_rdwr(*i2c_msgs)
+
+    def close(self) -> None:
+        self.bus.close()
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not defined here
+        if name == "bus":
+            raise AttributeError(name)
+        attribute = getattr(self.bus, name)
+        if name not in self._ADDRESSED_METHODS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def claimed(i2c_addr: int, *args, **kwargs):
+            with self.claim(i2c_addr):
+                return attribute(i2c_addr, *args, **kwargs)
+
+        return claimed
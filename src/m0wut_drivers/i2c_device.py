@@ -1,21 +1,302 @@
+from __future__ import annotations
+
 import smbus2
 import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
 
 
 class I2CDevice:
-    def __init__(self, i2c_bus: smbus2.SMBus, i2c_addr: int):
+    # SMBus block transfers are limited to 32 bytes
+    MAX_BLOCK_LENGTH = 32
+    # Registers which can change without being written by the driver
+    # (measurements, status flags etc.). These are never served from the
+    # register cache
+    VOLATILE_REGISTERS: frozenset[int] = frozenset()
+
+    def __init__(
+        self,
+        i2c_bus: smbus2.SMBus,
+        i2c_addr: int,
+        cache: bool = False,
+        volatile_registers: Optional[Iterable[int]] = None,
+        auto_increment: bool = True,
+        register_address_length: int = 1,
+        page_register: Optional[int] = None,
+        byte_addressed: Optional[bool] = None,
+    ):
+        """
+        If cache is True, the last value read from or written to each
+        non-volatile register is kept in a shadow copy and reads of that
+        register are served from it without touching the bus.
+
+        auto_increment should be True if the device steps its register
+        pointer through consecutive registers during a multi-byte transfer,
+        which allows batches to merge adjacent accesses.
+
+        byte_addressed (default auto_increment) should be True if each
+        register address is one byte, so a 16 bit register at N also holds
+        the byte at N + 1, and False if every address is a whole register
+        of its own (e.g. the INA3221). It decides which cache entries a
+        write overlaps.
+
+        register_address_length is the number of bytes (sent MSB first) in
+        the register address. SMBus commands only have one byte, so devices
+        with longer addresses are accessed with I2C_RDWR transfers.
+
+        If page_register is given, register addresses are 16 bit but only
+        the low byte is sent, after writing the high byte to page_register
+        in the same transfer. The page is only written when it changes
+        """
+        if register_address_length not in (1, 2):
+            raise ValueError(
+                "Unsupported register address length "
+                f"{register_address_length}"
+            )
+        if page_register is not None and register_address_length != 1:
+            raise ValueError("Paged addressing uses 1 byte register addresses")
         self.bus = i2c_bus
         self.addr = i2c_addr
+        self.auto_increment = auto_increment
+        self.byte_addressed = (
+            auto_increment if byte_addressed is None else byte_addressed
+        )
+        self.register_address_length = register_address_length
+        self.page_register = page_register
+        # Last value written to page_register, None if unknown. Held from
+        # building a transfer's page selects until it has been sent, so
+        # another thread can't change the page in between
+        self._page: Optional[int] = None
+        self._page_lock = threading.RLock()
+        # Whether accesses need I2C_RDWR rather than SMBus commands
+        self._use_rdwr = (
+            register_address_length > 1 or page_register is not None
+        )
         self.logger = logging.getLogger(__name__)
+        self.cache_enabled = cache
+        if volatile_registers is not None:
+            self.volatile_registers = frozenset(volatile_registers)
+        else:
+            self.volatile_registers = self.VOLATILE_REGISTERS
+        # Shadow copy of register values, keyed by (register, width in bytes)
+        self._cache: dict[tuple[int, int], int] = {}
+        # Registers written to the cache but not yet to the device
+        self._dirty: set[tuple[int, int]] = set()
+        self._defer_writes = False
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """
+        Keeps a multi-step sequence atomic when the bus is shared through an
+        I2CBusArbiter. Does nothing for a plain SMBus
+        """
+        claim = getattr(self.bus, "claim", None)
+        if claim is None:
+            yield
+            return
+        with claim(self.addr):
+            yield
+
+    def _is_cacheable(self, reg_addr: int) -> bool:
+        return self.cache_enabled and reg_addr not in self.volatile_registers
+
+    def _cache_lookup(self, reg_addr: int, width: int) -> Optional[int]:
+        if not self._is_cacheable(reg_addr):
+            return None
+        return self._cache.get((reg_addr, width))
+
+    def _cache_store(self, reg_addr: int, width: int, data: int) -> None:
+        if not self._is_cacheable(reg_addr):
+            return
+        # Drop (flushing if necessary) any entries accessed with a different
+        # width that overlap this register so they can't go stale
+        for other_width in (1, 2):
+            if self.byte_addressed:
+                overlaps = range(reg_addr - other_width + 1, reg_addr + width)
+            else:
+                overlaps = range(reg_addr, reg_addr + 1)
+            for other_addr in overlaps:
+                key = (other_addr, other_width)
+                if key == (reg_addr, width) or key not in self._cache:
+                    continue
+                covered = (
+                    other_addr >= reg_addr
+                    and other_addr + other_width <= reg_addr + width
+                )
+                if key in self._dirty and not covered:
+                    self._flush(*key)
+                self._dirty.discard(key)
+                del self._cache[key]
+        self._cache[(reg_addr, width)] = data
+
+    def _block_registers(self, reg_addr: int, length: int) -> range:
+        """Addresses of cache entries a block of length bytes overlaps"""
+        if self.byte_addressed:
+            # Also catch a 16 bit entry straddling the start of the block
+            return range(reg_addr - 1, reg_addr + length)
+        if self.auto_increment:
+            return range(reg_addr, reg_addr + (length + 1) // 2)
+        return range(reg_addr, reg_addr + 1)
+
+    def invalidate(self, reg_addr: Optional[int] = None) -> None:
+        """
+        Drops reg_addr (or all registers if None) from the register cache so
+        the next read goes to the device. Pending deferred writes to those
+        registers are discarded
+        """
+        if reg_addr is None:
+            self._cache.clear()
+            self._dirty.clear()
+            return
+        for key in [x for x in self._cache if x[0] == reg_addr]:
+            del self._cache[key]
+            self._dirty.discard(key)
+
+    def sync(self) -> None:
+        """Writes any deferred register writes to the device"""
+        with self.exclusive():
+            for key in sorted(self._dirty):
+                self._flush(*key)
+
+    def _flush(self, reg_addr: int, width: int) -> None:
+        data = self._cache[(reg_addr, width)]
+        if width == 1:
+            self._bus_write8(reg_addr, data)
+        else:
+            self._bus_write16(reg_addr, data)
+        self._dirty.discard((reg_addr, width))
+
+    @contextmanager
+    def deferred_writes(self) -> Iterator[None]:
+        """
+        Writes to cacheable registers inside this context only update the
+        register cache. They're written to the device by sync() when the
+        context exits, so a register modified several times is only written
+        once
+        """
+        if not self.cache_enabled:
+            raise RuntimeError("Deferred writes require the register cache")
+        self._defer_writes = True
+        try:
+            yield
+        finally:
+            self._defer_writes = False
+            self.sync()
+
+    def _register_address(self, reg_addr: int) -> bytes:
+        if self.page_register is not None:
+            return bytes([reg_addr & 0xFF])
+        return reg_addr.to_bytes(self.register_address_length, "big")
+
+    def _page_select(self, reg_addr: int) -> list[smbus2.i2c_msg]:
+        """
+        Returns the message selecting reg_addr's page if it isn't the
+        current one, for sending before the register address
+        """
+        if self.page_register is None or reg_addr >> 8 == self._page:
+            return []
+        self._page = reg_addr >> 8
+        return [
+            smbus2.i2c_msg.write(
+                self.addr, bytes([self.page_register, self._page])
+            )
+        ]
+
+    def _page_chunks(
+        self, reg_addr: int, length: int
+    ) -> list[tuple[int, int]]:
+        """
+        Splits a transfer into (reg_addr, length) chunks which don't cross
+        a page boundary, with paged addressing
+        """
+        if self.page_register is None:
+            return [(reg_addr, length)]
+        chunks = []
+        end = reg_addr + length
+        while reg_addr < end:
+            chunk_end = min(end, (reg_addr | 0xFF) + 1)
+            chunks.append((reg_addr, chunk_end - reg_addr))
+            reg_addr = chunk_end
+        return chunks
 
     def _read8(self, reg_addr: int) -> int:
-        return self.bus.read_byte_data(i2c_addr=self.addr, register=reg_addr)
+        data = self._cache_lookup(reg_addr, 1)
+        if data is None and self._use_rdwr:
+            with self.batch() as batch:
+                result = batch.read8(reg_addr)
+            data = result.result()
+        elif data is None:
+            data = self.bus.read_byte_data(
+                i2c_addr=self.addr, register=reg_addr
+            )
+            self._cache_store(reg_addr, 1, data)
+        return data
 
     def _read16(self, reg_addr: int) -> int:
-        data = self.bus.read_i2c_block_data(
-            i2c_addr=self.addr, register=reg_addr, length=2
-        )
-        return data[0] << 8 | data[1]
+        data = self._cache_lookup(reg_addr, 2)
+        if data is None and self._use_rdwr:
+            with self.batch() as batch:
+                result = batch.read16(reg_addr)
+            data = result.result()
+        elif data is None:
+            data_bytes = self.bus.read_i2c_block_data(
+                i2c_addr=self.addr, register=reg_addr, length=2
+            )
+            data = data_bytes[0] << 8 | data_bytes[1]
+            self._cache_store(reg_addr, 2, data)
+        return data
+
+    def _read_block(self, reg_addr: int, length: int) -> bytes:
+        """
+        Reads length bytes starting at reg_addr, relying on the device
+        auto-incrementing its register pointer. Reads longer than
+        MAX_BLOCK_LENGTH are split into several block reads, except for
+        devices with multi-byte register addresses, which are read in one
+        I2C_RDWR transfer
+        """
+        if self._use_rdwr:
+            with self.batch() as batch:
+                result = batch.read_block(reg_addr, length)
+            return result.result()
+        data = bytearray()
+        while len(data) < length:
+            chunk_length = min(length - len(data), self.MAX_BLOCK_LENGTH)
+            data += bytes(
+                self.bus.read_i2c_block_data(
+                    i2c_addr=self.addr,
+                    register=reg_addr + len(data),
+                    length=chunk_length,
+                )
+            )
+        return bytes(data)
+
+    def _read16_multi(self, reg_addrs: list[int]) -> list[int]:
+        """
+        Reads several 16 bit registers in a single combined I2C transaction.
+        Each register gets its own pointer write, so this works for devices
+        that don't auto-increment their register pointer
+        """
+        with self.batch() as batch:
+            results = [batch.read16(reg_addr) for reg_addr in reg_addrs]
+        return [x.result() for x in results]
+
+    @contextmanager
+    def batch(self) -> Iterator[I2CBatch]:
+        """
+        Queues register accesses and submits them as one combined I2C
+        transaction when the context exits. If an exception is raised
+        nothing is submitted and the queued reads are cancelled
+        """
+        batch = I2CBatch(self)
+        try:
+            yield batch
+        except BaseException:
+            batch.cancel()
+            raise
+        batch.commit()
 
     def _write8(self, reg_addr: int, data: int) -> None:
         if data > 0xFF:
@@ -23,9 +304,12 @@ class I2CDevice:
                 "Attempted to write value greater than 0xFF to 8 bit "
                 f"register: {hex(data)} to register {hex(reg_addr)}."
             )
-        self.bus.write_byte_data(
-            i2c_addr=self.addr, register=reg_addr, value=(data & 0xFF)
-        )
+        if self._defer_writes and self._is_cacheable(reg_addr):
+            self._cache_store(reg_addr, 1, data)
+            self._dirty.add((reg_addr, 1))
+            return
+        self._bus_write8(reg_addr, data)
+        self._cache_store(reg_addr, 1, data)
 
     def _write16(self, reg_addr: int, data: int) -> None:
         if data > 0xFFFF:
@@ -33,7 +317,269 @@ class I2CDevice:
                 "Attempted to write value greater than 0xFFFF to 16 bit "
                 f"register: {hex(data)} to register {hex(reg_addr)}."
             )
+        if self._defer_writes and self._is_cacheable(reg_addr):
+            self._cache_store(reg_addr, 2, data)
+            self._dirty.add((reg_addr, 2))
+            return
+        self._bus_write16(reg_addr, data)
+        self._cache_store(reg_addr, 2, data)
+
+    def _update_bits8(self, reg_addr: int, mask: int, data: int) -> None:
+        """
+        Replaces the bits of reg_addr set in mask with those from data.
+        With the register cache enabled, this doesn't need a bus read
+        """
+        with self.exclusive():
+            value = self._read8(reg_addr)
+            self._write8(reg_addr, (value & ~mask) | (data & mask))
+
+    def _update_bits16(self, reg_addr: int, mask: int, data: int) -> None:
+        """16 bit version of _update_bits8"""
+        with self.exclusive():
+            value = self._read16(reg_addr)
+            self._write16(reg_addr, (value & ~mask) | (data & mask))
+
+    def _bus_write8(self, reg_addr: int, data: int) -> None:
+        if self._use_rdwr:
+            self._bus_write_rdwr(reg_addr, bytes([data & 0xFF]))
+            return
+        self.bus.write_byte_data(
+            i2c_addr=self.addr, register=reg_addr, value=(data & 0xFF)
+        )
+
+    def _bus_write16(self, reg_addr: int, data: int) -> None:
         data_bytes = [(data >> 8) & 0xFF, data & 0xFF]
+        if self._use_rdwr:
+            self._bus_write_rdwr(reg_addr, bytes(data_bytes))
+            return
         self.bus.write_i2c_block_data(
             i2c_addr=self.addr, register=reg_addr, data=data_bytes
         )
+
+    def _bus_write_rdwr(self, reg_addr: int, data: bytes) -> None:
+        with self.exclusive(), self._page_lock:
+            messages = []
+            for chunk_addr, length in self._page_chunks(reg_addr, len(data)):
+                offset = chunk_addr - reg_addr
+                messages += self._page_select(chunk_addr)
+                messages.append(
+                    smbus2.i2c_msg.write(
+                        self.addr,
+                        self._register_address(chunk_addr)
+                        + data[offset : offset + length],
+                    )
+                )
+            try:
+                self.bus.i2c_rdwr(*messages)
+            except Exception:
+                self._page = None
+                raise
+
+
+@dataclass
+class _BatchOperation:
+    reg_addr: int
+    length: int
+    # None for reads
+    write_data: Optional[bytes] = None
+    # Register width in bytes, or 0 for block transfers
+    width: int = 0
+    future: Optional[Future] = None
+
+
+class I2CBatch:
+    """
+    Collects register reads and writes for an I2CDevice. On commit, runs of
+    consecutive registers accessed in the same direction are merged into
+    single block transfers (if the device auto-increments its register
+    pointer) and everything is submitted with as few i2c_rdwr calls as
+    possible. Reads return a Future which is resolved on commit
+    """
+
+    # Kernel limit on the number of messages in one I2C_RDWR ioctl
+    MAX_MESSAGES = 42
+
+    def __init__(self, device: I2CDevice):
+        self.device = device
+        self._operations: list[_BatchOperation] = []
+        self._results: list[Future] = []
+
+    def _queue_read(self, reg_addr: int, length: int, width: int) -> Future:
+        future: Future = Future()
+        self._results.append(future)
+        if width:
+            data = self.device._cache_lookup(reg_addr, width)
+            if data is not None:
+                future.set_result(data)
+                return future
+        self._operations.append(
+            _BatchOperation(
+                reg_addr=reg_addr, length=length, width=width, future=future
+            )
+        )
+        return future
+
+    def _queue_write(self, reg_addr: int, data: bytes, width: int) -> None:
+        self._operations.append(
+            _BatchOperation(
+                reg_addr=reg_addr,
+                length=len(data),
+                write_data=bytes(data),
+                width=width,
+            )
+        )
+
+    def read8(self, reg_addr: int) -> Future:
+        return self._queue_read(reg_addr, 1, 1)
+
+    def read16(self, reg_addr: int) -> Future:
+        return self._queue_read(reg_addr, 2, 2)
+
+    def read_block(self, reg_addr: int, length: int) -> Future:
+        return self._queue_read(reg_addr, length, 0)
+
+    def write8(self, reg_addr: int, data: int) -> None:
+        if data > 0xFF:
+            raise ValueError(
+                "Attempted to write value greater than 0xFF to 8 bit "
+                f"register: {hex(data)} to register {hex(reg_addr)}."
+            )
+        self._queue_write(reg_addr, bytes([data]), 1)
+
+    def write16(self, reg_addr: int, data: int) -> None:
+        if data > 0xFFFF:
+            raise ValueError(
+                "Attempted to write value greater than 0xFFFF to 16 bit "
+                f"register: {hex(data)} to register {hex(reg_addr)}."
+            )
+        self._queue_write(reg_addr, data.to_bytes(2, "big"), 2)
+
+    def write_block(self, reg_addr: int, data: bytes) -> None:
+        self._queue_write(reg_addr, data, 0)
+
+    def cancel(self) -> None:
+        """Discards the queued operations and cancels their futures"""
+        for operation in self._operations:
+            if operation.future is not None:
+                operation.future.cancel()
+        self._operations = []
+
+    def _coalesce(self) -> list[list[_BatchOperation]]:
+        """Groups operations which can share a single message"""
+        groups: list[list[_BatchOperation]] = []
+        for operation in self._operations:
+            if groups and self.device.auto_increment:
+                previous = groups[-1][-1]
+                same_direction = (operation.write_data is None) == (
+                    previous.write_data is None
+                )
+                contiguous = (
+                    operation.reg_addr == previous.reg_addr + previous.length
+                )
+                # Transfers are split at page boundaries anyway
+                same_page = (
+                    self.device.page_register is None
+                    or operation.reg_addr >> 8 == previous.reg_addr >> 8
+                )
+                if same_direction and contiguous and same_page:
+                    groups[-1].append(operation)
+                    continue
+            groups.append([operation])
+        return groups
+
+    def _submit(self, transfers: list[list[smbus2.i2c_msg]]) -> None:
+        """
+        Sends transfers (each a list of messages which must stay together)
+        using as few i2c_rdwr calls as the kernel's message limit allows
+        """
+        messages: list[smbus2.i2c_msg] = []
+        with self.device.exclusive():
+            for transfer in transfers:
+                if len(messages) + len(transfer) > self.MAX_MESSAGES:
+                    self.device.bus.i2c_rdwr(*messages)
+                    messages = []
+                messages += transfer
+            if messages:
+                self.device.bus.i2c_rdwr(*messages)
+
+    def commit(self) -> list:
+        """
+        Submits all queued operations and returns the results of the reads
+        in the order they were queued
+        """
+        addr = self.device.addr
+        operations = self._operations
+        transfers = []
+        reads = []
+        device = self.device
+        with device.exclusive(), device._page_lock:
+            for group in self._coalesce():
+                chunks = device._page_chunks(
+                    group[0].reg_addr, sum(x.length for x in group)
+                )
+                if group[0].write_data is None:
+                    messages = []
+                    for reg_addr, length in chunks:
+                        read = smbus2.i2c_msg.read(addr, length)
+                        pointer = smbus2.i2c_msg.write(
+                            addr, device._register_address(reg_addr)
+                        )
+                        transfers.append(
+                            device._page_select(reg_addr) + [pointer, read]
+                        )
+                        messages.append(read)
+                    reads.append((messages, group))
+                else:
+                    data = b"".join(x.write_data for x in group)
+                    for reg_addr, length in chunks:
+                        pointer = device._register_address(reg_addr)
+                        start = reg_addr - group[0].reg_addr
+                        chunk = data[start : start + length]
+                        transfers.append(
+                            device._page_select(reg_addr)
+                            + [smbus2.i2c_msg.write(addr, pointer + chunk)]
+                        )
+            self._operations = []
+
+            try:
+                self._submit(transfers)
+            except Exception as e:
+                device._page = None
+                for operation in operations:
+                    if operation.future is not None:
+                        operation.future.set_exception(e)
+                raise
+
+        for operation in operations:
+            if operation.write_data is None:
+                continue
+            if operation.width:
+                self.device._cache_store(
+                    operation.reg_addr,
+                    operation.width,
+                    int.from_bytes(operation.write_data, "big"),
+                )
+            else:
+                for reg_addr in self.device._block_registers(
+                    operation.reg_addr, operation.length
+                ):
+                    self.device.invalidate(reg_addr)
+
+        for messages, group in reads:
+            data = b"".join(bytes(x) for x in messages)
+            offset = 0
+            for operation in group:
+                chunk = data[offset : offset + operation.length]
+                offset += operation.length
+                if operation.width:
+                    value = int.from_bytes(chunk, "big")
+                    self.device._cache_store(
+                        operation.reg_addr, operation.width, value
+                    )
+                    operation.future.set_result(value)
+                else:
+                    operation.future.set_result(chunk)
+
+        results = [x.result() for x in self._results]
+        self._results = []
+        return results
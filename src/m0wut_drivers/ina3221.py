@@ -1,9 +1,58 @@
 from __future__ import annotations
 
+from array import array
+from dataclasses import dataclass
+from enum import Enum
+import time
+from typing import Iterator, Optional
+
 from m0wut_drivers.i2c_device import I2CDevice
+from m0wut_drivers.ring_buffer import RingBuffer
 import smbus2
 
 
+class INA3221Averaging(Enum):
+    AVG_1 = 0
+    AVG_4 = 1
+    AVG_16 = 2
+    AVG_64 = 3
+    AVG_128 = 4
+    AVG_256 = 5
+    AVG_512 = 6
+    AVG_1024 = 7
+
+
+class INA3221ConversionTime(Enum):
+    CT_140US = 0
+    CT_204US = 1
+    CT_332US = 2
+    CT_588US = 3
+    CT_1100US = 4
+    CT_2116US = 5
+    CT_4156US = 6
+    CT_8244US = 7
+
+
+class INA3221Mode(Enum):
+    POWER_DOWN = 0
+    SHUNT_SINGLE_SHOT = 1
+    BUS_SINGLE_SHOT = 2
+    SHUNT_AND_BUS_SINGLE_SHOT = 3
+    SHUNT_CONTINUOUS = 5
+    BUS_CONTINUOUS = 6
+    SHUNT_AND_BUS_CONTINUOUS = 7
+
+
+@dataclass(frozen=True, slots=True)
+class INA3221Reading:
+    """Measurements for all three channels, indexed by channel number - 1"""
+
+    bus_voltage: tuple[float, float, float]  # V
+    shunt_voltage: tuple[float, float, float]  # V
+    current: tuple[float, float, float]  # A
+    power: tuple[float, float, float]  # W
+
+
 class INA3221Channel:
     def __init__(
         self,
@@ -11,7 +60,7 @@ class INA3221Channel:
         channel_number: int,
         shunt_resistance: float,
     ):
-        if not 0 <= channel_number <= 2:
+        if not 1 <= channel_number <= 3:
             raise ValueError(f"Invalid channel number {channel_number}")
         self.parent_device = parent_device
         self.channel_number = channel_number
@@ -23,7 +72,7 @@ class INA3221Channel:
     def read_current(self) -> float:
         return (
             self.parent_device._read_shunt_voltage(self.channel_number)
-            * self.shunt_resistance
+            / self.shunt_resistance
         )
 
 
@@ -63,6 +112,37 @@ class INA3221:
     ]
     CRITICAL_LIMITS = [REG_CH1_CRITICAL, REG_CH2_CRITICAL, REG_CH3_CRITICAL]
     WARNING_LIMITS = [REG_CH1_WARNING, REG_CH2_WARNING, REG_CH3_WARNING]
+    # Shunt and bus voltage for each channel, in register order
+    MEASUREMENT_REGISTERS = list(
+        range(REG_CH1_SHUNT_VOLTAGE, REG_CH3_BUS_VOLTAGE + 1)
+    )
+    # Registers the chip updates itself, which can't be cached
+    VOLATILE_REGISTERS = frozenset(
+        MEASUREMENT_REGISTERS + [REG_SHUNT_VOLTAGE_SUM, REG_MASK_ENABLE]
+    )
+
+    # Config register fields
+    CONFIG_CHANNEL_ENABLE_SHIFT = 12  # Ch1 is bit 14, Ch3 is bit 12
+    CONFIG_AVERAGING_SHIFT = 9
+    CONFIG_BUS_CONVERSION_TIME_SHIFT = 6
+    CONFIG_SHUNT_CONVERSION_TIME_SHIFT = 3
+    CONFIG_MODE_SHIFT = 0
+    CONFIG_MODE_CONTINUOUS = 0x4
+    CONFIG_FIELD_MASK = 0x7
+    AVERAGING_COUNTS = [1, 4, 16, 64, 128, 256, 512, 1024]
+    CONVERSION_TIMES = [
+        140e-6,
+        204e-6,
+        332e-6,
+        588e-6,
+        1.1e-3,
+        2.116e-3,
+        4.156e-3,
+        8.244e-3,
+    ]
+
+    # Mask / Enable register fields
+    MASK_CONVERSION_READY = 1 << 0
 
     # Constants
     EXPECTED_MANUFACTURER_ID = 0x5449
@@ -76,8 +156,16 @@ class INA3221:
         i2c_bus: smbus2.SMBus,
         i2c_addr: int,
         shunt_resistances: list[float],
+        register_cache: bool = False,
     ):
-        self.dev = I2CDevice(i2c_bus=i2c_bus, i2c_addr=i2c_addr)
+        self.dev = I2CDevice(
+            i2c_bus=i2c_bus,
+            i2c_addr=i2c_addr,
+            cache=register_cache,
+            volatile_registers=self.VOLATILE_REGISTERS,
+            auto_increment=False,
+            byte_addressed=False,
+        )
         self._channels = [
             INA3221Channel(
                 parent_device=self,
@@ -99,14 +187,116 @@ class INA3221:
         self.validate_channel_number(channel_number)
         return self._channels[channel_number - 1]
 
+    def configure(
+        self,
+        averaging: Optional[INA3221Averaging] = None,
+        bus_conversion_time: Optional[INA3221ConversionTime] = None,
+        shunt_conversion_time: Optional[INA3221ConversionTime] = None,
+        mode: Optional[INA3221Mode] = None,
+        enabled_channels: Optional[list[int]] = None,
+    ) -> None:
+        """Updates the config register, settings left as None are unchanged"""
+        config = self.dev._read16(self.REG_CONFIG)
+        fields = [
+            (averaging, self.CONFIG_AVERAGING_SHIFT),
+            (bus_conversion_time, self.CONFIG_BUS_CONVERSION_TIME_SHIFT),
+            (shunt_conversion_time, self.CONFIG_SHUNT_CONVERSION_TIME_SHIFT),
+            (mode, self.CONFIG_MODE_SHIFT),
+        ]
+        for setting, shift in fields:
+            if setting is not None:
+                config &= ~(self.CONFIG_FIELD_MASK << shift)
+                config |= setting.value << shift
+        if enabled_channels is not None:
+            config &= ~(
+                self.CONFIG_FIELD_MASK << self.CONFIG_CHANNEL_ENABLE_SHIFT
+            )
+            for channel_number in enabled_channels:
+                self.validate_channel_number(channel_number)
+                config |= 1 << (
+                    self.CONFIG_CHANNEL_ENABLE_SHIFT + 3 - channel_number
+                )
+        self.dev._write16(self.REG_CONFIG, config)
+
+    def get_conversion_period(self) -> float:
+        """
+        Returns the time in seconds for one full conversion cycle
+        (i.e. between conversion ready flags) with the current config
+        """
+        config = self.dev._read16(self.REG_CONFIG)
+        mode = config >> self.CONFIG_MODE_SHIFT & self.CONFIG_FIELD_MASK
+        cycle_time = 0.0
+        if mode & 0x1:
+            cycle_time += self.CONVERSION_TIMES[
+                config >> self.CONFIG_SHUNT_CONVERSION_TIME_SHIFT
+                & self.CONFIG_FIELD_MASK
+            ]
+        if mode & 0x2:
+            cycle_time += self.CONVERSION_TIMES[
+                config >> self.CONFIG_BUS_CONVERSION_TIME_SHIFT
+                & self.CONFIG_FIELD_MASK
+            ]
+        enabled_channels = bin(
+            config >> self.CONFIG_CHANNEL_ENABLE_SHIFT & self.CONFIG_FIELD_MASK
+        ).count("1")
+        averaging = self.AVERAGING_COUNTS[
+            config >> self.CONFIG_AVERAGING_SHIFT & self.CONFIG_FIELD_MASK
+        ]
+        return cycle_time * enabled_channels * averaging
+
+    def is_continuous(self) -> bool:
+        """Returns True if the configured mode converts continuously"""
+        config = self.dev._read16(self.REG_CONFIG)
+        mode = config >> self.CONFIG_MODE_SHIFT & self.CONFIG_FIELD_MASK
+        # Modes 4 and 0 are both power down
+        return bool(mode & self.CONFIG_MODE_CONTINUOUS) and mode != 4
+
+    def is_conversion_ready(self) -> bool:
+        """
+        Checks the conversion ready flag. Note that reading the Mask / Enable
+        register clears the flag
+        """
+        return bool(
+            self.dev._read16(self.REG_MASK_ENABLE) & self.MASK_CONVERSION_READY
+        )
+
+    @staticmethod
+    def _decode_voltage(data: int) -> int:
+        """
+        Voltage registers have format [MSB:LSB] of 13 bits of two's
+        complement value then 3 padding zeros
+        """
+        return ((data ^ 0x8000) - 0x8000) >> 3
+
     def _read_voltage(self, reg_address: int) -> int:
+        return self._decode_voltage(self.dev._read16(reg_address))
+
+    def read_all(self) -> INA3221Reading:
         """
-        Voltage registers have format [MSB:LSB] of
-        [sign bit, 12 bits of value, 3 padding zeros]
+        Reads the shunt and bus voltages of all channels in one combined
+        I2C transaction. The INA3221 doesn't auto-increment its register
+        pointer, so this is a pointer write and 2 byte read per register
+        chained with repeated starts rather than a single block read
         """
-        data = self.dev._read16(reg_address)
-        sign = -1 if data & (1 << 15) else 1
-        return sign * ((data >> 3) & 0xFFF)
+        data = self.dev._read16_multi(self.MEASUREMENT_REGISTERS)
+        shunt_voltage = tuple(
+            self._decode_voltage(x) * self.SHUNT_VOLTAGE_PER_LSB
+            for x in data[0::2]
+        )
+        bus_voltage = tuple(
+            self._decode_voltage(x) * self.BUS_VOLTAGE_PER_LSB
+            for x in data[1::2]
+        )
+        current = tuple(
+            voltage / channel.shunt_resistance
+            for voltage, channel in zip(shunt_voltage, self._channels)
+        )
+        return INA3221Reading(
+            bus_voltage=bus_voltage,
+            shunt_voltage=shunt_voltage,
+            current=current,
+            power=tuple(v * i for v, i in zip(bus_voltage, current)),
+        )
 
     def validate_channel_number(self, channel_number: int) -> None:
         assert channel_number in self.VALID_CHANNELS
@@ -128,6 +318,100 @@ class INA3221:
         return voltage
 
 
+class INA3221Sampler:
+    """
+    Streams readings from an INA3221 in continuous mode at the chip's
+    conversion rate. Each sample is only read once the conversion ready flag
+    has been set (which reading clears) so the same conversion is never
+    returned twice. Gaps between conversion ready flags longer than the
+    conversion period are counted as dropped conversions, and flags less
+    than half a period apart as duplicate conversions (the chip's timing
+    doesn't match its configuration, e.g. because it was reconfigured)
+    """
+
+    COLUMNS = ("time",) + tuple(
+        f"ch{channel}_{quantity}"
+        for channel in INA3221.VALID_CHANNELS
+        for quantity in ["bus_voltage", "shunt_voltage", "current", "power"]
+    )
+
+    # Fraction of the conversion period to sleep before polling the
+    # conversion ready flag
+    SLEEP_FRACTION = 0.8
+    # Conversion periods to wait for the conversion ready flag before giving
+    # up with TimeoutError
+    TIMEOUT_PERIODS = 2
+
+    def __init__(self, device: INA3221, buffer_length: int = 4096):
+        self.device = device
+        self.buffer = RingBuffer(columns=self.COLUMNS, capacity=buffer_length)
+        self.dropped_conversions = 0
+        self.duplicate_conversions = 0
+        self.samples = 0
+
+    def stream(self) -> Iterator[tuple[float, INA3221Reading]]:
+        """
+        Yields (timestamp, reading) for each new conversion. Every sample is
+        also appended to self.buffer. Raises TimeoutError if no conversion
+        completes within TIMEOUT_PERIODS conversion periods
+        """
+        period = self.device.get_conversion_period()
+        if period == 0:
+            raise ValueError("INA3221 has no channels or measurements enabled")
+        if not self.device.is_continuous():
+            raise ValueError("INA3221Sampler needs a continuous mode")
+        # Discard any conversion that completed before we started
+        self.device.is_conversion_ready()
+        last_ready = time.monotonic()
+        first_sample = True
+        while True:
+            wake_time = last_ready + self.SLEEP_FRACTION * period
+            remaining = wake_time - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            deadline = last_ready + self.TIMEOUT_PERIODS * period
+            while not self.device.is_conversion_ready():
+                if time.monotonic() > deadline:
+                    raise TimeoutError(
+                        "No INA3221 conversion within "
+                        f"{self.TIMEOUT_PERIODS * period:.6f}s"
+                    )
+            timestamp = time.monotonic()
+            missed = round((timestamp - last_ready) / period) - 1
+            if missed > 0 and not first_sample:
+                self.dropped_conversions += missed
+            elif missed < 0 and not first_sample:
+                self.duplicate_conversions += 1
+            last_ready = timestamp
+            first_sample = False
+
+            reading = self.device.read_all()
+            self.samples += 1
+            row = [timestamp]
+            for channel in range(len(INA3221.VALID_CHANNELS)):
+                row += [
+                    reading.bus_voltage[channel],
+                    reading.shunt_voltage[channel],
+                    reading.current[channel],
+                    reading.power[channel],
+                ]
+            self.buffer.append(row)
+            yield timestamp, reading
+
+    def capture(self, n: int) -> dict[str, array]:
+        """
+        Captures n consecutive conversions and returns them as one array
+        per column (see COLUMNS). The arrays support the buffer protocol, so
+        can be wrapped with numpy.frombuffer without copying
+        """
+        self.buffer = RingBuffer(columns=self.COLUMNS, capacity=n)
+        stream = self.stream()
+        for _ in range(n):
+            next(stream)
+        stream.close()
+        return self.buffer.as_dict()
+
+
 def main():
     with smbus2.SMBus(1) as bus:
         x = INA3221(
@@ -135,6 +419,7 @@ def main():
         )
         ch1 = x.get_channel(1)
         print(ch1.read_voltage())
+        print(x.read_all())
 
 
 if __name__ == "__main__":
@@ -1,27 +1,42 @@
-import subprocess
-import re
+import math
+import os
 import socket
+import time
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
 from typing import Optional
 from uuid import getnode
 
 
 def read_cpu_temperature() -> float:
-    temperature = subprocess.check_output(
-        ["cat", "/sys/class/thermal/thermal_zone0/temp"]
-    )
-    return float(temperature) / 1000
+    with open("/sys/class/thermal/thermal_zone0/temp", "rb") as file:
+        return int(file.read()) / 1000
+
+
+def _meminfo_value(data: bytes, key: bytes) -> Optional[int]:
+    """Returns the value of key in /proc/meminfo contents, in bytes"""
+    start = data.find(b"\n" + key + b":")
+    if start == -1:
+        if not data.startswith(key + b":"):
+            return None
+        start = 0
+    else:
+        start += 1
+    end = data.find(b"\n", start)
+    # e.g. "MemTotal:        3884532 kB"
+    fields = data[start + len(key) + 1 : end if end != -1 else None].split()
+    value = int(fields[0])
+    return value * 1024 if len(fields) > 1 and fields[1] == b"kB" else value
 
 
 def read_memory_usage_percent() -> int:
-    """Returns total RAM in bytes"""
-    results = subprocess.check_output(["cat", "/proc/meminfo"]).strip().decode()
-    memstats = {}
-    results = [re.split(r"\s+", x[:-3]) for x in results.split("\n")]
-    for item in results:
-        key = item[0][:-1]
-        value = item[1]
-        memstats[key] = int(value)
-    return int(100 * (1 - memstats["MemAvailable"] / memstats["MemTotal"]))
+    """Returns percentage of RAM in use"""
+    with open("/proc/meminfo", "rb") as file:
+        data = file.read()
+    total = _meminfo_value(data, b"MemTotal")
+    available = _meminfo_value(data, b"MemAvailable")
+    return int(100 * (1 - available / total))
 
 
 def get_ip() -> Optional[str]:
@@ -49,3 +64,313 @@ def get_link_speed(interface_name: str = "eth0") -> int:
     # Returns wired link speed in Mbps
     with open(f"/sys/class/net/{interface_name}/speed") as file:
         return int(file.readline().strip())
+
+
+@dataclass
+class SystemSnapshot:
+    timestamp: float
+    # Degrees C for each thermal zone, keyed by zone (e.g. "thermal_zone0").
+    # NaN if the zone couldn't be read
+    temperatures: dict[str, float]
+    # Bytes
+    memory_total: int
+    memory_available: int
+    swap_total: Optional[int]
+    swap_free: Optional[int]
+    # Mbps for each interface, None if the link is down
+    link_speeds: dict[str, Optional[int]]
+
+    @property
+    def memory_usage_percent(self) -> float:
+        return 100 * (1 - self.memory_available / self.memory_total)
+
+    @property
+    def max_temperature(self) -> Optional[float]:
+        valid = [x for x in self.temperatures.values() if not math.isnan(x)]
+        return max(valid) if valid else None
+
+
+class SystemMonitor:
+    """
+    Reads CPU temperatures, memory usage and link speeds. Every file is
+    opened once and re-read with os.pread, which makes procfs and sysfs
+    regenerate the contents, so a snapshot costs a few system calls rather
+    than opening files or starting processes.
+
+    root is the filesystem root containing proc and sys, so the monitor can
+    be pointed at a copy of the tree
+    """
+
+    READ_SIZE = 8192
+
+    def __init__(
+        self, root: Path = Path("/"), interfaces: Optional[list[str]] = None
+    ):
+        """
+        interfaces are the network interfaces to report link speed for
+        (default: all except loopback)
+        """
+        self.root = Path(root)
+        self._meminfo_fd = os.open(self.root / "proc/meminfo", os.O_RDONLY)
+
+        self.thermal_zone_types: dict[str, str] = {}
+        self._thermal_fds: dict[str, int] = {}
+        thermal = self.root / "sys/class/thermal"
+        for zone in sorted(thermal.glob("thermal_zone*")):
+            try:
+                fd = os.open(zone / "temp", os.O_RDONLY)
+            except OSError:
+                continue
+            self._thermal_fds[zone.name] = fd
+            try:
+                zone_type = (zone / "type").read_text().strip()
+            except OSError:
+                zone_type = ""
+            self.thermal_zone_types[zone.name] = zone_type
+
+        net = self.root / "sys/class/net"
+        self._speed_fds: dict[str, int] = {}
+        if interfaces is None:
+            # Skip virtual interfaces without a speed attribute
+            for path in sorted(net.glob("*/speed")):
+                if path.parent.name != "lo":
+                    self._speed_fds[path.parent.name] = os.open(
+                        path, os.O_RDONLY
+                    )
+        else:
+            for interface in interfaces:
+                self._speed_fds[interface] = os.open(
+                    net / interface / "speed", os.O_RDONLY
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        for fd in [
+            self._meminfo_fd,
+            *self._thermal_fds.values(),
+            *self._speed_fds.values(),
+        ]:
+            os.close(fd)
+        self._thermal_fds.clear()
+        self._speed_fds.clear()
+
+    def _read_int(self, fd: int) -> Optional[int]:
+        try:
+            return int(os.pread(fd, 64, 0))
+        except (OSError, ValueError):
+            # e.g. the speed of an interface which is down gives EINVAL
+            return None
+
+    def read_temperatures(self) -> dict[str, float]:
+        temperatures = {}
+        for zone, fd in self._thermal_fds.items():
+            millidegrees = self._read_int(fd)
+            temperatures[zone] = (
+                math.nan if millidegrees is None else millidegrees / 1000
+            )
+        return temperatures
+
+    def snapshot(self) -> SystemSnapshot:
+        meminfo = os.pread(self._meminfo_fd, self.READ_SIZE, 0)
+        link_speeds = {}
+        for interface, fd in self._speed_fds.items():
+            speed = self._read_int(fd)
+            link_speeds[interface] = (
+                speed if speed is not None and speed >= 0 else None
+            )
+        return SystemSnapshot(
+            timestamp=time.time(),
+            temperatures=self.read_temperatures(),
+            memory_total=_meminfo_value(meminfo, b"MemTotal"),
+            memory_available=_meminfo_value(meminfo, b"MemAvailable"),
+            swap_total=_meminfo_value(meminfo, b"SwapTotal"),
+            swap_free=_meminfo_value(meminfo, b"SwapFree"),
+            link_speeds=link_speeds,
+        )
+
+
+def _counter_delta(current: int, previous: int) -> int:
+    """
+    Increase in a counter which may have wrapped. Counters below 2**32
+    may be 32 bit, as some network drivers still use, and are taken to
+    have wrapped if that is an increase of less than half their range.
+    Any other decrease is a reset (e.g. the interface was recreated or the
+    driver reloaded) and counts as no increase
+    """
+    if current >= previous:
+        return current - previous
+    wrapped = current + (1 << 32) - previous
+    if previous < 1 << 32 and wrapped < 1 << 31:
+        return wrapped
+    return 0
+
+
+def _cpu_delta(current: int, previous: int) -> int:
+    # /proc/stat times can step backwards (iowait notably) so don't treat
+    # that as a wrap
+    return max(0, current - previous)
+
+
+@dataclass(frozen=True)
+class InterfaceRates:
+    # Per second
+    rx_bytes: float
+    tx_bytes: float
+    rx_packets: float
+    tx_packets: float
+    rx_errors: float
+    tx_errors: float
+
+
+@dataclass
+class UtilisationSample:
+    timestamp: float
+    # Seconds since the previous sample
+    interval: float
+    # Busy percentage of all CPUs together and of each core. Cores are
+    # empty for the sample after CPUs go on or offline
+    cpu_busy_percent: float
+    core_busy_percent: list[float]
+    interfaces: dict[str, InterfaceRates]
+
+
+class UtilisationSampler:
+    """
+    CPU utilisation from /proc/stat and network rates from interface
+    statistics counters. Files are kept open and re-read with os.pread, the
+    previous counters are kept in arrays and deltas are computed with map()
+    over all cores and interfaces at once. The first sample() gives rates
+    since the sampler was created
+    """
+
+    NET_COUNTERS = (
+        "rx_bytes",
+        "tx_bytes",
+        "rx_packets",
+        "tx_packets",
+        "rx_errors",
+        "tx_errors",
+    )
+    # /proc/stat fields counted: user nice system idle iowait irq softirq
+    # steal (guest time is already included in user)
+    CPU_FIELDS = 8
+
+    def __init__(
+        self, root: Path = Path("/"), interfaces: Optional[list[str]] = None
+    ):
+        """
+        interfaces are the network interfaces to report rates for (default:
+        all except loopback)
+        """
+        self.root = Path(root)
+        self._stat_fd = os.open(self.root / "proc/stat", os.O_RDONLY)
+        self._stat_read_size = 4096
+
+        net = self.root / "sys/class/net"
+        if interfaces is None:
+            interfaces = sorted(
+                x.parent.name
+                for x in net.glob("*/statistics")
+                if x.parent.name != "lo"
+            )
+        self.interfaces = list(interfaces)
+        # One fd per counter, interface major
+        self._net_fds = [
+            os.open(net / interface / "statistics" / counter, os.O_RDONLY)
+            for interface in self.interfaces
+            for counter in self.NET_COUNTERS
+        ]
+
+        self._previous_time = time.monotonic()
+        self._previous_cpu_total, self._previous_cpu_idle = self._read_cpu()
+        self._previous_net = self._read_net()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        for fd in [self._stat_fd, *self._net_fds]:
+            os.close(fd)
+        self._net_fds.clear()
+
+    def _read_stat(self) -> bytes:
+        # Only the cpu lines at the start are needed, the rest of the file
+        # (interrupt counts in particular) can be large
+        while True:
+            data = os.pread(self._stat_fd, self._stat_read_size, 0)
+            if b"\nintr" in data or len(data) < self._stat_read_size:
+                return data
+            self._stat_read_size *= 2
+
+    def _read_cpu(self) -> tuple[array, array]:
+        """
+        Returns the total and idle jiffies of all CPUs together followed by
+        each core
+        """
+        total = array("Q")
+        idle = array("Q")
+        for line in self._read_stat().split(b"\n"):
+            if not line.startswith(b"cpu"):
+                break
+            values = list(map(int, line.split()[1 : self.CPU_FIELDS + 1]))
+            total.append(sum(values))
+            # idle + iowait
+            idle.append(values[3] + values[4])
+        return total, idle
+
+    def _read_net(self) -> array:
+        return array("Q", (int(os.pread(fd, 32, 0)) for fd in self._net_fds))
+
+    def sample(self) -> UtilisationSample:
+        now = time.monotonic()
+        interval = now - self._previous_time
+        cpu_total, cpu_idle = self._read_cpu()
+        net = self._read_net()
+
+        if len(cpu_total) == len(self._previous_cpu_total):
+            lines = len(cpu_total)
+        else:
+            # CPUs went on or offline so the per-core counters don't line
+            # up with the previous ones. Only compare all CPUs together
+            lines = 1
+        total_delta = list(
+            map(_cpu_delta, cpu_total[:lines], self._previous_cpu_total)
+        )
+        idle_delta = map(_cpu_delta, cpu_idle[:lines], self._previous_cpu_idle)
+        busy_percent = [
+            100 * (total - idle) / total if total else 0.0
+            for total, idle in zip(total_delta, idle_delta)
+        ]
+
+        net_delta = map(_counter_delta, net, self._previous_net)
+        if interval > 0:
+            rates = [delta / interval for delta in net_delta]
+        else:
+            rates = [0.0] * len(net)
+        counters = len(self.NET_COUNTERS)
+        interfaces = {
+            interface: InterfaceRates(
+                *rates[i * counters : (i + 1) * counters]
+            )
+            for i, interface in enumerate(self.interfaces)
+        }
+
+        self._previous_time = now
+        self._previous_cpu_total = cpu_total
+        self._previous_cpu_idle = cpu_idle
+        self._previous_net = net
+        return UtilisationSample(
+            timestamp=time.time(),
+            interval=interval,
+            cpu_busy_percent=busy_percent[0],
+            core_busy_percent=busy_percent[1:],
+            interfaces=interfaces,
+        )
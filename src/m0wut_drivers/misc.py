@@ -1,2 +1,32 @@
 class DeviceNotFoundError(Exception):
     pass
+
+
+class DiagnosticsNotSupportedError(Exception):
+    """Raised when a device doesn't implement the requested diagnostics"""
+
+
+class GPIOExportTimeoutError(Exception):
+    """Raised when exported GPIOs don't become writable in time"""
+
+    def __init__(self, gpios: list[int]):
+        self.gpios = gpios
+        super().__init__(
+            "Timed out waiting for exported GPIO(s) to become writable: "
+            + ", ".join(str(x) for x in gpios)
+        )
+
+
+class RegisterVerificationError(Exception):
+    """Raised when registers read back differently to what was written"""
+
+    def __init__(self, mismatches: dict[int, tuple[int, int]]):
+        # Register address -> (expected, read back)
+        self.mismatches = mismatches
+        super().__init__(
+            "Register verification failed: "
+            + ", ".join(
+                f"{hex(reg)}: wrote {hex(expected)}, read {hex(actual)}"
+                for reg, (expected, actual) in sorted(mismatches.items())
+            )
+        )
@@ -1,8 +1,55 @@
 from __future__ import annotations
 
+import re
 import smbus2
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum, auto
+from m0wut_drivers.gpio import GPIO, Edge, GPIOEdgeWatcher
 from m0wut_drivers.i2c_device import I2CDevice
+from m0wut_drivers.misc import RegisterVerificationError
 import logging
+from pathlib import Path
+from typing import Callable, Optional
+
+
+class RC32504AAddressMode(Enum):
+    """Register offset size the chip's I2C interface is configured for"""
+
+    # Only registers up to 0xFF are reachable
+    ONE_BYTE = auto()
+    TWO_BYTE = auto()
+    # 1 byte offsets with the upper address byte in RC32504A.PAGE_REGISTER
+    PAGED = auto()
+
+
+@dataclass(frozen=True)
+class RC32504AStatus:
+    dpll_locked: bool
+    apll_locked: bool
+    # Any input monitor reporting loss of signal / frequency out of range
+    loss_of_signal: bool
+    activity_fault: bool
+    dpll_lol_count: int
+    apll_lol_count: int
+    # Raw register values
+    interrupt_status: int
+    losmon_status: int
+    losmon_event: int
+    actmon_status: int
+    actmon_event: int
+    dpll_status: int
+    dpll_event: int
+    apll_status: int
+    apll_event: int
+
+
+@dataclass(frozen=True)
+class RC32504AEvent:
+    timestamp: float  # time.time()
+    status: RC32504AStatus
 
 
 class RC32504AChannel:
@@ -123,12 +170,93 @@ class RC32504A(I2CDevice):
     # Clock Input Registers
     REG_REF_CLK_IN_CNFG = 0x190
 
+    # Status, event and counter registers which the chip updates itself
+    VOLATILE_REGISTERS = frozenset(
+        [
+            REG_DEVICE_RESET,
+            REG_SW_RESET,
+            REG_DEVICE_STS,
+            REG_INT_STS,
+            REG_INT_STS + 1,
+            REG_LOSMON_STS,
+            REG_LOSMON_EVENT,
+            REG_ACTMON_STS,
+            REG_ACTMON_EVENT,
+            REG_DPLL_STS,
+            REG_DPLL_EVENT,
+            REG_DPLL_LOL_CNT,
+            REG_BIAS_STS,
+            REG_STARTUP_STS,
+            REG_GPIO_STS,
+            REG_VCO_CAL_STS,
+            REG_APLL_STS,
+            REG_APLL_EVENT,
+            REG_APLL_LOL_CNT,
+        ]
+    )
+
+    # Status register bits
+    DPLL_STS_LOCK = 0x01
+    APLL_STS_LOCK = 0x01
+    # Registers read by read_status(), in one combined transaction
+    STATUS_REGISTERS = (
+        REG_INT_STS,
+        REG_INT_STS + 1,
+        REG_LOSMON_STS,
+        REG_LOSMON_EVENT,
+        REG_ACTMON_STS,
+        REG_ACTMON_EVENT,
+        REG_DPLL_STS,
+        REG_DPLL_EVENT,
+        REG_DPLL_LOL_CNT,
+        REG_APLL_STS,
+        REG_APLL_EVENT,
+        REG_APLL_LOL_CNT,
+    )
+
+    # Configuration images must fit in the register space
+    MAX_REGISTER = 0x1FF
+    # Holds the upper byte of register addresses in paged addressing mode
+    PAGE_REGISTER = 0xFC
+    # Registers read in one transfer when gathering a configuration can be
+    # this far apart before a new transfer is started
+    READ_GAP = 8
+
     # Constants
     EXPECTED_DEVICE_ID = 0x304A
     EXPECTED_DEVICE_REVISION = 0x0232
 
-    def __init__(self, i2c_bus: smbus2.SMBus, i2c_addr: int):
-        super().__init__(i2c_bus=i2c_bus, i2c_addr=i2c_addr)
+    def __init__(
+        self,
+        i2c_bus: smbus2.SMBus,
+        i2c_addr: int,
+        register_cache: bool = False,
+        address_mode: RC32504AAddressMode = RC32504AAddressMode.TWO_BYTE,
+    ):
+        """
+        address_mode must match the register offset size the device's I2C
+        interface is configured for. In ONE_BYTE mode the output, GPIO, SSI
+        and APLL blocks above 0xFF can't be reached
+        """
+        super().__init__(
+            i2c_bus=i2c_bus,
+            i2c_addr=i2c_addr,
+            cache=register_cache,
+            register_address_length=(
+                2 if address_mode == RC32504AAddressMode.TWO_BYTE else 1
+            ),
+            page_register=(
+                self.PAGE_REGISTER
+                if address_mode == RC32504AAddressMode.PAGED
+                else None
+            ),
+        )
+        self.address_mode = address_mode
+        self.max_register = (
+            0xFF
+            if address_mode == RC32504AAddressMode.ONE_BYTE
+            else self.MAX_REGISTER
+        )
         self.logger = logging.getLogger(__name__)
         assert self._read16(self.REG_DEVICE_ID) == self.EXPECTED_DEVICE_ID
         x = self._read16(self.REG_DEVICE_REV)
@@ -156,6 +284,281 @@ class RC32504A(I2CDevice):
     def get_channels(self) -> list[RC32504AChannel]:
         return self._channels
 
+    @classmethod
+    def parse_configuration_image(cls, text: str) -> dict[int, int]:
+        """
+        Parses a configuration image with one register per line, given as
+        address then value in hex (with or without 0x, e.g. "0x0100, 0x12"
+        or "0100 12" as exported by the vendor tool). Anything after #, ;
+        or // is a comment
+        """
+        image = {}
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            line = re.split(r"#|;|//", line, maxsplit=1)[0]
+            tokens = re.findall(r"(?:0[xX])?[0-9A-Fa-f]+", line)
+            if not tokens:
+                continue
+            if len(tokens) != 2:
+                raise ValueError(
+                    f"Invalid configuration image line {line_number}: {line}"
+                )
+            reg_addr, value = (int(x, 16) for x in tokens)
+            if reg_addr > cls.MAX_REGISTER or value > 0xFF:
+                raise ValueError(
+                    f"Invalid register {hex(reg_addr)} = {hex(value)} on "
+                    f"configuration image line {line_number}"
+                )
+            image[reg_addr] = value
+        return image
+
+    @classmethod
+    def load_configuration_image(cls, path: Path) -> dict[int, int]:
+        return cls.parse_configuration_image(Path(path).read_text())
+
+    @staticmethod
+    def _runs(reg_addrs: list[int], max_gap: int) -> list[tuple[int, int]]:
+        """
+        Groups sorted register addresses into (start, length) runs, where
+        addresses up to max_gap apart are in the same run
+        """
+        runs: list[tuple[int, int]] = []
+        for reg_addr in reg_addrs:
+            if runs:
+                start, length = runs[-1]
+                if reg_addr - (start + length) < max_gap:
+                    runs[-1] = (start, reg_addr - start + 1)
+                    continue
+            runs.append((reg_addr, 1))
+        return runs
+
+    def read_registers(self, reg_addrs: list[int]) -> dict[int, int]:
+        """
+        Reads the given 8 bit registers in one combined transaction, using
+        block reads for nearby registers
+        """
+        reg_addrs = sorted(set(reg_addrs))
+        if reg_addrs and reg_addrs[-1] > self.max_register:
+            raise ValueError(
+                f"Register {hex(reg_addrs[-1])} is not reachable in "
+                f"{self.address_mode.name} address mode"
+            )
+        with self.batch() as batch:
+            blocks = [
+                (start, batch.read_block(start, length))
+                for start, length in self._runs(reg_addrs, self.READ_GAP)
+            ]
+        values = {}
+        for start, block in blocks:
+            data = block.result()
+            for offset, value in enumerate(data):
+                values[start + offset] = value
+        return {x: values[x] for x in reg_addrs}
+
+    def write_configuration(
+        self,
+        image: dict[int, int],
+        verify: bool = True,
+        include_volatile: bool = False,
+    ) -> int:
+        """
+        Programs a configuration image (register address -> value). The
+        current values are read back in bulk and only registers that differ
+        are written, with runs of consecutive registers combined into burst
+        writes, all in one combined transaction. Status and event registers
+        in the image are skipped unless include_volatile is True, as writing
+        them clears flags rather than configuring anything.
+
+        If verify is True, the written registers are read back and
+        RegisterVerificationError raised if any differ. Returns the number
+        of registers written
+        """
+        if not include_volatile:
+            image = {
+                reg: value
+                for reg, value in image.items()
+                if reg not in self.volatile_registers
+            }
+        with self.exclusive():
+            current = self.read_registers(list(image))
+            changed = sorted(
+                reg for reg, value in image.items() if current[reg] != value
+            )
+            with self.batch() as batch:
+                for start, length in self._runs(changed, 1):
+                    batch.write_block(
+                        start,
+                        bytes(image[x] for x in range(start, start + length)),
+                    )
+            self.logger.debug(
+                f"Wrote {len(changed)} of {len(image)} RC32504A registers"
+            )
+
+            if verify and changed:
+                readback = self.read_registers(changed)
+                mismatches = {
+                    reg: (image[reg], readback[reg])
+                    for reg in changed
+                    if readback[reg] != image[reg]
+                }
+                if mismatches:
+                    raise RegisterVerificationError(mismatches)
+        return len(changed)
+
+    def read_status(self) -> RC32504AStatus:
+        """
+        Reads lock, loss of signal and activity monitor state and the event
+        registers in one combined I2C transaction
+        """
+        x = self.read_registers(list(self.STATUS_REGISTERS))
+        return RC32504AStatus(
+            dpll_locked=bool(x[self.REG_DPLL_STS] & self.DPLL_STS_LOCK),
+            apll_locked=bool(x[self.REG_APLL_STS] & self.APLL_STS_LOCK),
+            loss_of_signal=bool(x[self.REG_LOSMON_STS]),
+            activity_fault=bool(x[self.REG_ACTMON_STS]),
+            dpll_lol_count=x[self.REG_DPLL_LOL_CNT],
+            apll_lol_count=x[self.REG_APLL_LOL_CNT],
+            interrupt_status=x[self.REG_INT_STS] << 8
+            | x[self.REG_INT_STS + 1],
+            losmon_status=x[self.REG_LOSMON_STS],
+            losmon_event=x[self.REG_LOSMON_EVENT],
+            actmon_status=x[self.REG_ACTMON_STS],
+            actmon_event=x[self.REG_ACTMON_EVENT],
+            dpll_status=x[self.REG_DPLL_STS],
+            dpll_event=x[self.REG_DPLL_EVENT],
+            apll_status=x[self.REG_APLL_STS],
+            apll_event=x[self.REG_APLL_EVENT],
+        )
+
+    def clear_events(self, status: RC32504AStatus) -> None:
+        """
+        Clears the event and interrupt flags set in status (they are write
+        1 to clear) in one combined transaction, leaving any which were set
+        after status was read
+        """
+        with self.batch() as batch:
+            for reg_addr, value in (
+                (self.REG_LOSMON_EVENT, status.losmon_event),
+                (self.REG_ACTMON_EVENT, status.actmon_event),
+                (self.REG_DPLL_EVENT, status.dpll_event),
+                (self.REG_APLL_EVENT, status.apll_event),
+            ):
+                if value:
+                    batch.write8(reg_addr, value)
+            if status.interrupt_status:
+                batch.write16(self.REG_INT_STS, status.interrupt_status)
+
+
+class RC32504AEventMonitor:
+    """
+    Watches the RC32504A interrupt output through an edge triggered GPIO
+    instead of polling the chip. The bus is only touched when the INT pin
+    asserts: the status is read, the events counted and cleared, and the
+    listeners called with an RC32504AEvent. The last history_length events
+    are kept in self.events.
+
+    int_gpio is an input GPIO whose polarity matches the INT output (active
+    low unless the chip has been configured otherwise). Callbacks run on
+    the GPIOEdgeWatcher thread
+    """
+
+    EVENT_TYPES = ("losmon", "actmon", "dpll", "apll")
+    # Limit on status reads per interrupt if INT doesn't release
+    MAX_SERVICE_READS = 8
+
+    def __init__(
+        self,
+        device: RC32504A,
+        int_gpio: GPIO,
+        interrupts: int = 0xFFFF,
+        history_length: int = 256,
+        watcher: Optional[GPIOEdgeWatcher] = None,
+    ):
+        """interrupts is the value written to REG_INT_EN when started"""
+        self.device = device
+        self.int_gpio = int_gpio
+        self.interrupts = interrupts
+        self.watcher = watcher
+        self.logger = logging.getLogger(__name__)
+        self.events: deque[RC32504AEvent] = deque(maxlen=history_length)
+        self.event_counts = {x: 0 for x in self.EVENT_TYPES}
+        self.last_event_times: dict[str, Optional[float]] = {
+            x: None for x in self.EVENT_TYPES
+        }
+        self.interrupt_count = 0
+        self._listeners: list[Callable[[RC32504AEvent], None]] = []
+        self._lock = threading.Lock()
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.stop()
+
+    def add_listener(self, listener: Callable[[RC32504AEvent], None]):
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        self.int_gpio.set_direction(GPIO.INPUT)
+        # Edges are logic levels, so assertion of an active low pin falls
+        self.int_gpio.set_edge(
+            Edge.FALLING if self.int_gpio.active_low else Edge.RISING
+        )
+        self._running = True
+        self.int_gpio.add_edge_callback(self._on_edge, self.watcher)
+        self.device.clear_events(self.device.read_status())
+        self.device._write16(self.device.REG_INT_EN, self.interrupts)
+        # Catch anything which asserted INT before the callback was added
+        if self.int_gpio.read():
+            self._service()
+
+    def stop(self) -> None:
+        self._running = False
+        self.int_gpio.remove_edge_callback(self._on_edge, self.watcher)
+        self.device._write16(self.device.REG_INT_EN, 0)
+
+    def _on_edge(self, gpio: GPIO, asserted: bool) -> None:
+        if asserted and self._running:
+            self._service()
+
+    def _service(self) -> None:
+        with self._lock:
+            # INT stays asserted while any enabled event is pending, so
+            # keep going until it releases in case another event arrived
+            # between reading and clearing the status
+            for _ in range(self.MAX_SERVICE_READS):
+                try:
+                    status = self.device.read_status()
+                    self.device.clear_events(status)
+                except OSError:
+                    self.logger.exception("Reading RC32504A status failed")
+                    return
+                self._record(status)
+                if not self.int_gpio.read():
+                    return
+            self.logger.warning("RC32504A INT still asserted after clearing")
+
+    def _record(self, status: RC32504AStatus) -> None:
+        now = time.time()
+        self.interrupt_count += 1
+        for event_type, value in (
+            ("losmon", status.losmon_event),
+            ("actmon", status.actmon_event),
+            ("dpll", status.dpll_event),
+            ("apll", status.apll_event),
+        ):
+            if value:
+                self.event_counts[event_type] += 1
+                self.last_event_times[event_type] = now
+        event = RC32504AEvent(timestamp=now, status=status)
+        self.events.append(event)
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception:
+                self.logger.exception("RC32504A event listener failed")
+
 
 def main():
     pass
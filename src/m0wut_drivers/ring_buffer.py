@@ -0,0 +1,58 @@
+from array import array
+from typing import Sequence
+
+
+class RingBuffer:
+    """
+    Fixed size circular buffer of numeric samples. Each column is stored in
+    its own preallocated array so appending a sample never allocates and the
+    oldest samples are overwritten once the buffer is full
+    """
+
+    def __init__(
+        self, columns: Sequence[str], capacity: int, typecode: str = "d"
+    ):
+        if capacity <= 0:
+            raise ValueError(f"Invalid ring buffer capacity {capacity}")
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.typecode = typecode
+        self._data = [
+            array(typecode, bytes(array(typecode).itemsize * capacity))
+            for _ in self.columns
+        ]
+        self._index = 0  # Next row to be written
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, row: Sequence[float]) -> None:
+        """Adds a sample, with one value per column"""
+        index = self._index
+        for column, value in zip(self._data, row):
+            column[index] = value
+        self._index = (index + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def clear(self) -> None:
+        self._index = 0
+        self._count = 0
+
+    def latest(self) -> tuple:
+        """Returns the most recently added sample"""
+        if self._count == 0:
+            raise IndexError("Ring buffer is empty")
+        index = self._index - 1
+        return tuple(column[index] for column in self._data)
+
+    def column(self, name: str) -> array:
+        """Returns a copy of a column's samples, oldest first"""
+        data = self._data[self.columns.index(name)]
+        if self._count < self.capacity:
+            return data[: self._count]
+        return data[self._index :] + data[: self._index]
+
+    def as_dict(self) -> dict[str, array]:
+        return {name: self.column(name) for name in self.columns}
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from typing import Hashable, Optional
+
+from m0wut_drivers.rs485_framing import RS485FrameParser
+from m0wut_drivers.rs485_message_handler import MessageHandler, RS485Packet
+
+
+class AsyncMessageHandler:
+    """
+    asyncio transport for a MessageHandler, using the same wire format.
+    Received data is parsed by a reader callback on the event loop and each
+    response is handed to the query waiting for it, matched on the
+    response's address and (in framed mode) command. Responses nobody is
+    waiting for are put on self.unsolicited.
+
+    Queries are serialized, as only one device can talk on a half duplex
+    bus, but awaiting a response doesn't block the event loop so other I/O
+    carries on while the bus is busy.
+
+    The reader callback is the only reader of the serial port. Data read
+    while transmitting is held with the time it was read and, once the
+    transmit time and direction switching are known, only what was read
+    before the end of the glitch window is discarded
+    """
+
+    READ_SIZE = 4096
+
+    def __init__(
+        self,
+        handler: MessageHandler,
+        timeout: float = 0.2,
+        unsolicited_queue_length: int = 100,
+    ):
+        self.handler = handler
+        self.timeout = timeout
+        self.parser = RS485FrameParser()
+        self._line = bytearray()
+        self._pending: dict[Hashable, asyncio.Future] = {}
+        self._bus_lock = asyncio.Lock()
+        # (time.monotonic() when read, data) for data received while
+        # transmitting, or None when not transmitting
+        self._held: Optional[list[tuple[float, bytes]]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.unsolicited: asyncio.Queue = asyncio.Queue(
+            maxsize=unsolicited_queue_length
+        )
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        self.close()
+
+    def start(self) -> None:
+        """Starts reading from the serial port on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self.handler.serial.fileno(), self._on_readable)
+
+    def close(self) -> None:
+        if self._loop is not None:
+            self._loop.remove_reader(self.handler.serial.fileno())
+            self._loop = None
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def _response_key(self, address: int, command: Optional[int]) -> Hashable:
+        return (address, command if self.handler.framed else None)
+
+    def _request_key(self, packet: RS485Packet) -> Hashable:
+        # Responses are addressed back to us
+        command = packet.command
+        if isinstance(command, str) and self.handler.framed:
+            command = ord(command)
+        return self._response_key(self.handler.rs485_addr, command)
+
+    def _on_readable(self) -> None:
+        try:
+            data = os.read(self.handler.serial.fileno(), self.READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            return
+        if self._held is not None:
+            self._held.append((time.monotonic(), data))
+            return
+        self._process(data)
+
+    def _process(self, data: bytes) -> None:
+        if self.handler.framed:
+            self.parser.feed(data)
+            for address, command, payload in self.parser:
+                self._dispatch(
+                    self._response_key(address, command),
+                    RS485Packet(
+                        address=address, command=command, payload=payload
+                    ),
+                )
+        else:
+            self._line += data
+            while (end := self._line.find(b"\n")) != -1:
+                line = bytes(self._line[: end + 1])
+                del self._line[: end + 1]
+                self._dispatch(
+                    self._response_key(line[0], None),
+                    line.decode(errors="replace")[1:],
+                )
+
+    def _dispatch(self, key: Hashable, response: str | RS485Packet) -> None:
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+        elif not self.unsolicited.full():
+            self.unsolicited.put_nowait(response)
+
+    async def _write(self, packet: RS485Packet) -> None:
+        # Anything partially received is stale once we start transmitting
+        self.parser.reset()
+        self._line.clear()
+        self._held = []
+        try:
+            # Blocks for the transmission time and direction switching, so
+            # keep it off the event loop
+            discard_until = await asyncio.get_running_loop().run_in_executor(
+                None, self.handler.transmit, packet
+            )
+        finally:
+            held, self._held = self._held, None
+        for read_time, data in held:
+            if read_time < discard_until:
+                self.handler.discarded_bytes += len(data)
+            else:
+                self._process(data)
+
+    async def write(self, packet: RS485Packet) -> None:
+        """Sends a packet without waiting for a response"""
+        async with self._bus_lock:
+            await self._write(packet)
+
+    async def query(
+        self, packet: RS485Packet, timeout: Optional[float] = None
+    ) -> Optional[str | RS485Packet]:
+        """
+        Sends packet and waits for the response, returning None if none
+        arrives within timeout (default self.timeout)
+        """
+        key = self._request_key(packet)
+        async with self._bus_lock:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            try:
+                await self._write(packet)
+                return await asyncio.wait_for(
+                    future, self.timeout if timeout is None else timeout
+                )
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+from typing import Iterator, Optional
+
+
+def _make_crc16_table() -> list[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _make_crc16_table()
+
+
+def crc16(data: bytes | bytearray | memoryview) -> int:
+    """CRC-16/MODBUS (poly 0x8005 reflected, init 0xFFFF)"""
+    crc = 0xFFFF
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class RS485Frame:
+    """
+    Binary frame layout:
+    [address, payload length, command, payload..., CRC16 LSB, CRC16 MSB]
+    with the CRC covering everything before it
+    """
+
+    HEADER_LENGTH = 3
+    CRC_LENGTH = 2
+    OVERHEAD = HEADER_LENGTH + CRC_LENGTH
+    MAX_PAYLOAD_LENGTH = 0xFF
+
+    @classmethod
+    def encode(cls, address: int, command: int, payload: bytes) -> bytes:
+        if len(payload) > cls.MAX_PAYLOAD_LENGTH:
+            raise ValueError(
+                f"RS485 payload of {len(payload)} bytes is longer than "
+                f"{cls.MAX_PAYLOAD_LENGTH}"
+            )
+        frame = bytearray((address, len(payload), command))
+        frame += payload
+        frame += crc16(frame).to_bytes(2, "little")
+        return bytes(frame)
+
+
+class RS485FrameParser:
+    """
+    Incremental frame parser. Received bytes are appended to one reusable
+    buffer with feed() and complete frames are taken out with next_frame()
+    (or by iterating). CRCs are checked on memoryview slices of the buffer
+    so only the payload of a valid frame is copied. On a CRC error the
+    parser skips a single byte and searches for the next valid frame
+    rather than discarding everything received. An incomplete frame is
+    waited for, not searched, as its payload can contain anything
+    """
+
+    def __init__(self, address: Optional[int] = None):
+        """
+        If address is not None, frames for other addresses are skipped
+        without returning them
+        """
+        self.address = address
+        self._buffer = bytearray()
+        self._start = 0
+        # Statistics
+        self.frames = 0
+        # Valid frames skipped because they were for another address
+        self.other_frames = 0
+        self.crc_errors = 0
+        self.discarded_bytes = 0
+
+    def __len__(self) -> int:
+        """Number of buffered bytes not yet parsed"""
+        return len(self._buffer) - self._start
+
+    def feed(self, data: bytes | bytearray | memoryview) -> None:
+        if self._start:
+            # Drop parsed bytes. bytearray deletes from the front cheaply
+            del self._buffer[: self._start]
+            self._start = 0
+        self._buffer += data
+
+    def reset(self) -> None:
+        """Discards any partially received frame"""
+        self.discarded_bytes += len(self)
+        self._buffer.clear()
+        self._start = 0
+
+    def skip_partial_frame(self) -> None:
+        """
+        Gives up on the incomplete frame at the start of the buffer, e.g.
+        when the rest hasn't arrived by a timeout because its length byte
+        was corrupt. Parsing resumes from the next byte
+        """
+        if len(self):
+            self.crc_errors += 1
+            self.discarded_bytes += 1
+            self._start += 1
+
+    @staticmethod
+    def _is_valid(view: memoryview, start: int, crc_start: int) -> bool:
+        received_crc = view[crc_start] | view[crc_start + 1] << 8
+        return crc16(view[start:crc_start]) == received_crc
+
+    def next_frame(self) -> Optional[tuple[int, int, bytes]]:
+        """
+        Returns (address, command, payload) for the next complete valid
+        frame in the buffer, or None if more data is needed
+        """
+        buffer = self._buffer
+        view = memoryview(buffer)
+        try:
+            while len(buffer) - self._start >= RS485Frame.OVERHEAD:
+                start = self._start
+                payload_start = start + RS485Frame.HEADER_LENGTH
+                crc_start = payload_start + buffer[start + 1]
+                end = crc_start + RS485Frame.CRC_LENGTH
+                if end > len(buffer):
+                    # Wait for the rest of the frame. Its payload may
+                    # contain anything, including valid looking frames, so
+                    # never search inside it. A corrupt length byte is
+                    # resolved by the CRC check once enough bytes arrive,
+                    # or by skip_partial_frame() after a timeout
+                    return None
+                if not self._is_valid(view, start, crc_start):
+                    self.crc_errors += 1
+                    self.discarded_bytes += 1
+                    self._start += 1
+                    continue
+                self._start = end
+                address = buffer[start]
+                if self.address is not None and address != self.address:
+                    self.other_frames += 1
+                    continue
+                self.frames += 1
+                return (
+                    address,
+                    buffer[start + 2],
+                    bytes(view[payload_start:crc_start]),
+                )
+            return None
+        finally:
+            view.release()
+
+    def __iter__(self) -> Iterator[tuple[int, int, bytes]]:
+        while (frame := self.next_frame()) is not None:
+            yield frame
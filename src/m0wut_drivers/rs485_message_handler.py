@@ -1,24 +1,72 @@
 from dataclasses import dataclass
+import select
+import time
+from typing import Optional
 from m0wut_drivers.gpio import GPIO
+from m0wut_drivers.histogram import LatencyHistogram
 from m0wut_drivers.misc import DeviceNotFoundError
+from m0wut_drivers.rs485_framing import RS485Frame, RS485FrameParser
 import serial
+import serial.rs485
 from pathlib import Path
 
 
 @dataclass
 class RS485Packet:
     address: int
-    command: str
-    payload: str
+    # In framed mode, command is a single byte (int or one character) and
+    # payload can be binary
+    command: str | int
+    payload: str | bytes
+
+    def encode_frame(self) -> bytes:
+        command = self.command
+        if isinstance(command, str):
+            if len(command) != 1:
+                raise ValueError(
+                    f"Framed RS485 commands must be one byte, got {command}"
+                )
+            command = ord(command)
+        payload = self.payload
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        return RS485Frame.encode(self.address, command, payload)
 
 
 class MessageHandler:
     TX = 1
     RX = 0
+    # RS485 UART characters are 10 bits (start, 8 data, stop)
+    BITS_PER_CHARACTER = 10
+    # Below this, waits for the end of transmission spin rather than sleep
+    SPIN_TIME = 1e-3
 
     def __init__(
-        self, serial_file: Path, baud: int, trx_gpio: GPIO, rs485_addr: int
+        self,
+        serial_file: Path,
+        baud: int,
+        trx_gpio: Optional[GPIO],
+        rs485_addr: int,
+        framed: bool = False,
+        kernel_rs485: bool = False,
+        drain_margin: float = 50e-6,
+        glitch_window: Optional[float] = None,
     ):
+        """
+        By default messages are newline terminated text. If framed is True,
+        binary frames with a length and CRC are used instead
+        (see RS485Frame) and responses are read with read_packet()
+
+        If kernel_rs485 is True, the UART driver switches the transceiver
+        direction itself with RTS (TIOCSRS485) and trx_gpio may be None.
+        Otherwise trx_gpio is switched back to RX drain_margin seconds after
+        the data should have finished transmitting, calculated from its
+        length and the baud rate. Anything received up to glitch_window
+        (default one character time) after switching is discarded as
+        switching glitches. USB serial adapters buffer data so their
+        transmission can't be timed like this: use kernel RS485 mode or a
+        larger drain_margin with them
+        """
 
         try:
             self.serial = serial.Serial(
@@ -27,41 +75,154 @@ class MessageHandler:
         except serial.SerialException:
             raise DeviceNotFoundError(serial_file)
 
+        self.kernel_rs485 = kernel_rs485
+        if kernel_rs485:
+            self.serial.rs485_mode = serial.rs485.RS485Settings(
+                rts_level_for_tx=True,
+                rts_level_for_rx=False,
+                delay_before_tx=0,
+                delay_before_rx=0,
+            )
+        elif trx_gpio is None:
+            raise ValueError("trx_gpio is required without kernel RS485 mode")
+
         self.gpio = trx_gpio
-        self.gpio.set_direction(GPIO.OUTPUT)
-        self.gpio.write(GPIO.LOW)
         self.rs485_addr = rs485_addr
+        self.framed = framed
+        self.parser = RS485FrameParser(address=rs485_addr)
+        # Received text not yet returned by read(), which may include the
+        # start of the next line
+        self._line_buffer = bytearray()
+        self.character_time = self.BITS_PER_CHARACTER / baud
+        self.drain_margin = drain_margin
+        self.glitch_window = (
+            self.character_time if glitch_window is None else glitch_window
+        )
 
-        self.set_direction(self.RX)
+        # Turnaround instrumentation (GPIO direction switching only).
+        # tx_latency is the time taken to enable the transmitter and
+        # rx_latency how late the switch back to RX is after the end of
+        # transmission
+        self.tx_latency = LatencyHistogram()
+        self.rx_latency = LatencyHistogram()
+        self.discarded_bytes = 0
+
+        if self.gpio is not None:
+            self.gpio.set_direction(GPIO.OUTPUT)
+            self.set_direction(self.RX)
         self.serial.reset_input_buffer()
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args, **kwargs):
-        self.gpio.write(GPIO.LOW)
+        if self.gpio is not None:
+            self.set_direction(self.RX)
         self.serial.reset_input_buffer()
         self.serial.reset_output_buffer()
 
     def set_direction(self, x: bool | int):
         self.gpio.write(x)
 
-    def write(self, x: RS485Packet):
+    def _encode(self, x: RS485Packet) -> bytes:
+        if self.framed:
+            return x.encode_frame()
         address = x.address.to_bytes(1, "big")
         command = x.command.encode("utf-8")
-        self.set_direction(self.TX)
-        payload = x.payload.encode("utf-8")
+        payload = x.payload
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        return address + command + payload + b"\n"
+
+    def _wait_until(self, deadline: float) -> None:
+        remaining = deadline - time.monotonic()
+        if remaining > self.SPIN_TIME:
+            time.sleep(remaining - self.SPIN_TIME)
+        while time.monotonic() < deadline:
+            pass
 
-        self.serial.write(address + command + payload + b"\n")
-        self.serial.flush()
+    def transmit(self, x: RS485Packet) -> float:
+        """
+        Sends x and switches back to receive without reading anything.
+        Returns the time.monotonic() value before which anything received
+        is stale or switching glitches, for callers doing their own reads
+        """
+        data = self._encode(x)
+        if self.kernel_rs485:
+            start = time.monotonic()
+            self.serial.write(data)
+            return start
+
+        start = time.monotonic()
+        self.set_direction(self.TX)
+        tx_start = time.monotonic()
+        self.tx_latency.record(tx_start - start)
+        self.serial.write(data)
+        # The transmitter was idle so the last bit leaves a fixed time
+        # after the write, which tcdrain() (serial.flush()) only reports
+        # with the driver's timer granularity
+        tx_end = tx_start + len(data) * self.character_time
+        self._wait_until(tx_end + self.drain_margin)
         self.set_direction(self.RX)
+        rx_start = time.monotonic()
+        self.rx_latency.record(rx_start - tx_end)
+        # Changing RS485 from TX to RX introduces glitches on the RX line
+        return rx_start + self.glitch_window
 
-        # Changing RS485 from TX to RX introduces glitches on the
-        # RX line so clear the buffer
-        self.serial.reset_input_buffer()
+    def write(self, x: RS485Packet):
+        discard_until = self.transmit(x)
+        if not self.kernel_rs485:
+            # Discard what was received up to the end of the glitch window
+            # but not anything later, which may be the start of a fast reply
+            self._wait_until(discard_until)
+            if waiting := self.serial.in_waiting:
+                self.discarded_bytes += len(self.serial.read(waiting))
+        self.parser.reset()
+        self._line_buffer.clear()
 
-    def read(self) -> str:
-        x = self.serial.readline()
+    def _read_available(self, deadline: Optional[float]) -> bytes:
+        """
+        Reads whatever has been received, waiting for at least one byte
+        until deadline (a time.monotonic() value) or, if deadline is None,
+        for the serial timeout. Returns b"" on timeout
+        """
+        if deadline is not None and not self.serial.in_waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return b""
+            readable, _, _ = select.select(
+                [self.serial.fileno()], [], [], remaining
+            )
+            if not readable:
+                return b""
+        return self.serial.read(max(1, self.serial.in_waiting))
+
+    def _readline(self, deadline: Optional[float]) -> bytes:
+        """
+        Returns the next complete line, or b"" if there isn't one by
+        deadline. Anything received after the line is kept for the next
+        call, as is a partial line
+        """
+        buffer = self._line_buffer
+        while (end := buffer.find(b"\n")) == -1:
+            data = self._read_available(deadline)
+            if not data:
+                return b""
+            buffer += data
+        line = bytes(buffer[: end + 1])
+        del buffer[: end + 1]
+        return line
+
+    def read(self, timeout: Optional[float] = None) -> str:
+        """
+        Reads a line addressed to us. If timeout is given, it replaces the
+        serial timeout for this read. Returns "" if no complete line
+        arrives in time
+        """
+        if timeout is None:
+            timeout = self.serial.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        x = self._readline(deadline)
         if x == b"":
             return ""
 
@@ -70,7 +231,38 @@ class MessageHandler:
 
         return x.decode()[1:]  # Remove address character
 
-    def query(self, packet: RS485Packet) -> str:
+    def read_packet(
+        self, timeout: Optional[float] = None
+    ) -> Optional[RS485Packet]:
+        """
+        Framed mode equivalent of read(). Returns the next valid frame
+        addressed to us or None if nothing arrives before the timeout
+        (default: the serial timeout). Corrupt frames are skipped
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.parser.next_frame()
+            if frame is not None:
+                break
+            data = self._read_available(deadline)
+            if not data:
+                # The rest of a partial frame never arrived, so its length
+                # byte may be corrupt. Look for a complete frame after it
+                while frame is None and len(self.parser):
+                    self.parser.skip_partial_frame()
+                    frame = self.parser.next_frame()
+                if frame is None:
+                    return None
+                break
+            self.parser.feed(data)
+        address, command, payload = frame
+        return RS485Packet(address=address, command=command, payload=payload)
+
+    def query(
+        self, packet: RS485Packet, timeout: Optional[float] = None
+    ) -> str | Optional[RS485Packet]:
         self.write(packet)
-        response = self.read()
+        if self.framed:
+            return self.read_packet(timeout)
+        response = self.read(timeout)
         return response
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from m0wut_drivers.rs485_message_handler import MessageHandler, RS485Packet
+
+
+@dataclass
+class RS485NodeStatistics:
+    queries: int = 0
+    responses: int = 0
+    timeouts: int = 0
+    # Smoothed response time and its mean deviation, in seconds
+    latency: Optional[float] = None
+    latency_deviation: float = 0.0
+    min_latency: Optional[float] = None
+    max_latency: Optional[float] = None
+    consecutive_failures: int = 0
+    # True once the node has stopped answering and is only being probed
+    down: bool = False
+    # Polling cycles to skip before the next probe of a down node
+    probe_interval: int = 0
+    cycles_until_probe: int = 0
+
+
+class RS485Poller:
+    """
+    Master side poller for a multi-drop bus. Addresses are queried in turn
+    and the response timeout for each address is derived from its own
+    measured response time (smoothed mean + 4 * mean deviation, as TCP
+    does for retransmission timeouts) plus the time to receive a reply at
+    the bus baud rate. After failure_threshold consecutive timeouts, a node
+    is marked down and only probed occasionally, with the gap between probes
+    doubling up to max_probe_interval cycles, so dead nodes don't dominate
+    the cycle time
+    """
+
+    # Weights for the smoothed latency and deviation estimates
+    LATENCY_GAIN = 1 / 8
+    DEVIATION_GAIN = 1 / 4
+    # RS485 UART characters are 10 bits (start, 8 data, stop)
+    BITS_PER_CHARACTER = 10
+
+    def __init__(
+        self,
+        handler: MessageHandler,
+        addresses: list[int],
+        response_length: int = 16,
+        min_timeout: float = 2e-3,
+        max_timeout: float = 0.2,
+        failure_threshold: int = 3,
+        max_probe_interval: int = 64,
+    ):
+        """
+        response_length is the expected length of a reply in bytes, used to
+        allow for its transmission time in the timeout
+        """
+        self.handler = handler
+        self.addresses = list(addresses)
+        self.response_length = response_length
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.failure_threshold = failure_threshold
+        self.max_probe_interval = max_probe_interval
+        self.statistics = {x: RS485NodeStatistics() for x in self.addresses}
+
+    def get_timeout(self, address: int) -> float:
+        stats = self.statistics[address]
+        if stats.latency is None:
+            return self.max_timeout
+        reply_time = (
+            self.response_length
+            * self.BITS_PER_CHARACTER
+            / self.handler.serial.baudrate
+        )
+        timeout = stats.latency + 4 * stats.latency_deviation + reply_time
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def _record_response(self, address: int, latency: float) -> None:
+        stats = self.statistics[address]
+        stats.responses += 1
+        stats.consecutive_failures = 0
+        stats.down = False
+        stats.probe_interval = 0
+        stats.cycles_until_probe = 0
+        if stats.latency is None:
+            stats.latency = latency
+            stats.latency_deviation = latency / 2
+        else:
+            error = latency - stats.latency
+            stats.latency += self.LATENCY_GAIN * error
+            stats.latency_deviation += self.DEVIATION_GAIN * (
+                abs(error) - stats.latency_deviation
+            )
+        if stats.min_latency is None or latency < stats.min_latency:
+            stats.min_latency = latency
+        if stats.max_latency is None or latency > stats.max_latency:
+            stats.max_latency = latency
+
+    def _record_timeout(self, address: int) -> None:
+        stats = self.statistics[address]
+        stats.timeouts += 1
+        stats.consecutive_failures += 1
+        if stats.down:
+            stats.probe_interval = min(
+                2 * stats.probe_interval, self.max_probe_interval
+            )
+        elif stats.consecutive_failures >= self.failure_threshold:
+            stats.down = True
+            stats.probe_interval = 1
+        stats.cycles_until_probe = stats.probe_interval
+
+    def poll(self, packet: RS485Packet) -> Optional[str | RS485Packet]:
+        """
+        Queries packet.address using its adaptive timeout. Returns the
+        response or None on timeout
+        """
+        address = packet.address
+        timeout = self.get_timeout(address)
+        self.statistics[address].queries += 1
+        self.handler.write(packet)
+        start = time.monotonic()
+        if self.handler.framed:
+            response = self.handler.read_packet(timeout)
+        else:
+            response = self.handler.read(timeout) or None
+        if response is None:
+            self._record_timeout(address)
+        else:
+            self._record_response(address, time.monotonic() - start)
+        return response
+
+    def poll_cycle(
+        self, make_packet: Callable[[int], RS485Packet]
+    ) -> dict[int, Optional[str | RS485Packet]]:
+        """
+        Polls each address once (skipping down nodes which aren't due a
+        probe) with the packet returned by make_packet(address). Returns
+        the responses of the nodes polled, None for those that timed out
+        """
+        responses = {}
+        for address in self.addresses:
+            stats = self.statistics[address]
+            if stats.down and stats.cycles_until_probe > 0:
+                stats.cycles_until_probe -= 1
+                continue
+            responses[address] = self.poll(make_packet(address))
+        return responses
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import logging
+import os
+import select
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from m0wut_drivers.histogram import LatencyHistogram
+from m0wut_drivers.rs485_framing import RS485FrameParser
+from m0wut_drivers.rs485_message_handler import MessageHandler, RS485Packet
+
+RS485CommandHandler = Callable[
+    [RS485Packet], Optional[str | bytes | RS485Packet]
+]
+
+
+@dataclass
+class RS485SlaveStatistics:
+    # Valid frames or lines seen on the bus, for any address
+    frames_seen: int = 0
+    frames_for_us: int = 0
+    responses: int = 0
+    unknown_commands: int = 0
+    handler_errors: int = 0
+    # Time spent in command handlers
+    handler_latency: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+
+class RS485SlaveServer:
+    """
+    Slave side of the protocol used by MessageHandler. Requests addressed to
+    handler.rs485_addr are dispatched on their command to the registered
+    handler, whose return value is sent back to master_address with the
+    same command. A handler returns the response payload, a complete
+    RS485Packet or None to not respond.
+
+    In text mode commands are the single character after the address byte.
+    Lines for other addresses are dropped on their first byte without being
+    decoded. In framed mode the frame parser skips frames for other
+    addresses after checking their CRC, which is needed to stay in sync,
+    without copying their payload.
+
+    Received data is read into one preallocated buffer so the server can
+    run indefinitely without allocating per byte. The server keeps its own
+    frame parser because handler.write() resets handler.parser, which would
+    drop requests received in the same read as the one being answered
+    """
+
+    READ_SIZE = 4096
+
+    def __init__(self, handler: MessageHandler, master_address: int = 0):
+        self.handler = handler
+        self.master_address = master_address
+        self.logger = logging.getLogger(__name__)
+        self.statistics = RS485SlaveStatistics()
+        self._handlers: dict[str | int, RS485CommandHandler] = {}
+        self._read_buffer = bytearray(self.READ_SIZE)
+        self._read_view = memoryview(self._read_buffer)
+        self._line = bytearray()
+        self._parser = RS485FrameParser(address=handler.rs485_addr)
+        self._running = False
+
+    def _command_key(self, command: str | int) -> str | int:
+        if self.handler.framed and isinstance(command, str):
+            return ord(command)
+        if not self.handler.framed and isinstance(command, int):
+            return chr(command)
+        return command
+
+    def register(self, command: str | int, handler: RS485CommandHandler):
+        """Sets the handler for command, a single character or byte"""
+        self._handlers[self._command_key(command)] = handler
+
+    def unregister(self, command: str | int) -> None:
+        self._handlers.pop(self._command_key(command), None)
+
+    def _dispatch(self, packet: RS485Packet) -> None:
+        self.statistics.frames_for_us += 1
+        command_handler = self._handlers.get(packet.command)
+        if command_handler is None:
+            self.statistics.unknown_commands += 1
+            return
+        start = time.monotonic()
+        try:
+            response = command_handler(packet)
+        except Exception:
+            self.statistics.handler_errors += 1
+            self.logger.exception(
+                f"RS485 handler for command {packet.command!r} failed"
+            )
+            return
+        finally:
+            self.statistics.handler_latency.record(time.monotonic() - start)
+        if response is None:
+            return
+        if not isinstance(response, RS485Packet):
+            response = RS485Packet(
+                address=self.master_address,
+                command=packet.command,
+                payload=response,
+            )
+        try:
+            self.handler.write(response)
+        except Exception:
+            self.statistics.handler_errors += 1
+            self.logger.exception(
+                f"RS485 response to command {packet.command!r} failed"
+            )
+            return
+        self.statistics.responses += 1
+
+    def _process_frames(self, data: memoryview) -> None:
+        parser = self._parser
+        parser.feed(data)
+        for address, command, payload in parser:
+            self.statistics.frames_seen += 1
+            self._dispatch(
+                RS485Packet(address=address, command=command, payload=payload)
+            )
+        self.statistics.frames_seen += parser.other_frames
+        parser.other_frames = 0
+
+    def _process_lines(self, data: memoryview) -> None:
+        line = self._line
+        line += data
+        start = 0
+        while (end := line.find(b"\n", start)) != -1:
+            self.statistics.frames_seen += 1
+            # Address byte, command character, payload, newline
+            if line[start] == self.handler.rs485_addr and end - start >= 2:
+                self._dispatch(
+                    RS485Packet(
+                        address=line[start],
+                        command=chr(line[start + 1]),
+                        payload=line[start + 2 : end].decode(errors="replace"),
+                    )
+                )
+            start = end + 1
+        del line[:start]
+
+    def handle_requests(self, timeout: Optional[float] = None) -> int:
+        """
+        Waits up to timeout (forever if None) for data and handles any
+        complete requests received. Returns the number of bytes read
+        """
+        fd = self.handler.serial.fileno()
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            return 0
+        length = os.readv(fd, [self._read_view])
+        data = self._read_view[:length]
+        try:
+            if self.handler.framed:
+                self._process_frames(data)
+            else:
+                self._process_lines(data)
+        finally:
+            data.release()
+        return length
+
+    def serve_forever(self, poll_interval: float = 0.1) -> None:
+        """Handles requests until stop() is called from another thread"""
+        self._running = True
+        while self._running:
+            self.handle_requests(poll_interval)
+
+    def stop(self) -> None:
+        self._running = False
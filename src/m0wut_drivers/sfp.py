@@ -1,6 +1,9 @@
 # Standard imports
 from dataclasses import dataclass
+from enum import IntFlag
 import logging
+import struct
+import time
 from typing import Optional
 
 # Third-party imports
@@ -9,6 +12,8 @@ import smbus2
 # Local imports
 from m0wut_drivers.i2c_device import I2CDevice
 from m0wut_drivers.gpio import GPIO, RPiGPIO
+from m0wut_drivers.misc import DiagnosticsNotSupportedError
+from m0wut_drivers.ring_buffer import RingBuffer
 
 
 @dataclass()
@@ -17,9 +22,150 @@ class SFPInfo:
     manufacturer: str
     partNumber: str
     revision: str
+    # Only populated when the EEPROM is read in bulk
+    vendorOui: Optional[str] = None
+    serialNumber: Optional[str] = None
+    dateCode: Optional[str] = None
+    wavelength: Optional[int] = None  # nm
+    bitRate: Optional[int] = None  # MBd
+    transceiverCodes: Optional[bytes] = None
+    baseChecksumValid: Optional[bool] = None
+    extendedChecksumValid: Optional[bool] = None
+
+
+class SFPDiagnosticFlag(IntFlag):
+    """
+    Alarm / warning flags from the A2h page. Bytes 112-113 (alarms) and
+    116-117 (warnings) share this layout when read as a big endian word
+    """
+
+    TEMPERATURE_HIGH = 1 << 15
+    TEMPERATURE_LOW = 1 << 14
+    VCC_HIGH = 1 << 13
+    VCC_LOW = 1 << 12
+    TX_BIAS_HIGH = 1 << 11
+    TX_BIAS_LOW = 1 << 10
+    TX_POWER_HIGH = 1 << 9
+    TX_POWER_LOW = 1 << 8
+    RX_POWER_HIGH = 1 << 7
+    RX_POWER_LOW = 1 << 6
+
+
+@dataclass()
+class SFPDiagnostics:
+    temperature: float  # degC
+    vcc: float  # V
+    txBias: float  # mA
+    txPower: float  # mW
+    rxPower: float  # mW
+    alarms: SFPDiagnosticFlag
+    warnings: SFPDiagnosticFlag
+
+
+@dataclass()
+class SFPCalibration:
+    """
+    SFF-8472 external calibration constants. The defaults are the identity
+    calibration, which is what internally calibrated modules use
+    """
+
+    rxPower: tuple[float, ...] = (0.0, 0.0, 0.0, 1.0, 0.0)  # Rx_PWR(4..0)
+    txBiasSlope: float = 1.0
+    txBiasOffset: int = 0
+    txPowerSlope: float = 1.0
+    txPowerOffset: int = 0
+    temperatureSlope: float = 1.0
+    temperatureOffset: int = 0
+    vccSlope: float = 1.0
+    vccOffset: int = 0
+
+
+def parse_sfp_calibration(data: bytes) -> SFPCalibration:
+    """Decodes the calibration constants from A2h bytes 56-91"""
+    values = struct.unpack(">5fHhHhHhHh", data[:36])
+    return SFPCalibration(
+        rxPower=values[0:5],
+        txBiasSlope=values[5] / 256,
+        txBiasOffset=values[6],
+        txPowerSlope=values[7] / 256,
+        txPowerOffset=values[8],
+        temperatureSlope=values[9] / 256,
+        temperatureOffset=values[10],
+        vccSlope=values[11] / 256,
+        vccOffset=values[12],
+    )
+
+
+def _decode_sfp_type(connector: int) -> Optional[str]:
+    if connector == 7:
+        return "LC"
+    else:
+        return None
+
+
+def _decode_str(data: bytes) -> str:
+    # Fields are ASCII padded with spaces
+    return data.decode("ascii", errors="replace").strip()
+
+
+def parse_sfp_eeprom(data: bytes) -> SFPInfo:
+    """
+    Decodes the SFF-8472 serial ID fields from a snapshot of the A0h page.
+    Only the first 96 bytes are used
+    """
+    if len(data) < SFP.ID_FIELDS_LENGTH:
+        raise ValueError(
+            f"SFP EEPROM snapshot too short: {len(data)} bytes, expected at "
+            f"least {SFP.ID_FIELDS_LENGTH}"
+        )
+
+    bit_rate = data[12] * 100
+    if data[12] == 0xFF:
+        # Nominal rate is above 25.4GBd, so is stored in byte 66 in
+        # units of 250MBd
+        bit_rate = data[66] * 250
+
+    return SFPInfo(
+        sfpType=_decode_sfp_type(data[2]) or "Unknown",
+        manufacturer=_decode_str(data[20:36]),
+        partNumber=_decode_str(data[40:56]),
+        revision=_decode_str(data[56:60]),
+        vendorOui=data[37:40].hex(":").upper(),
+        serialNumber=_decode_str(data[68:84]),
+        dateCode=_decode_str(data[84:92]),
+        wavelength=data[60] << 8 | data[61],
+        bitRate=bit_rate,
+        transceiverCodes=bytes(data[3:11]),
+        baseChecksumValid=(sum(data[0:63]) & 0xFF) == data[63],
+        extendedChecksumValid=(sum(data[64:95]) & 0xFF) == data[95],
+    )
 
 
 class SFP:
+    EEPROM_PAGE_LENGTH = 256
+    # Serial ID fields, up to and including CC_EXT
+    ID_FIELDS_LENGTH = 96
+
+    # Digital diagnostics (A2h page)
+    REG_DIAGNOSTIC_MONITORING_TYPE = 92  # In A0h page
+    DDM_IMPLEMENTED = 1 << 6
+    DDM_EXTERNALLY_CALIBRATED = 1 << 4
+    REG_DDM_CALIBRATION = 56
+    DDM_CALIBRATION_LENGTH = 36
+    REG_DDM_MEASUREMENTS = 96
+    # Measurements through to the warning flags, fits in one block read
+    DDM_MEASUREMENTS_LENGTH = 22
+    DIAGNOSTICS_COLUMNS = (
+        "time",
+        "temperature",
+        "vcc",
+        "tx_bias",
+        "tx_power",
+        "rx_power",
+        "alarms",
+        "warnings",
+    )
+
     def __init__(
         self,
         i2c_bus: smbus2.SMBus,
@@ -29,13 +175,41 @@ class SFP:
         gpio_tx_fault: Optional[GPIO] = None,
         gpio_los: Optional[GPIO] = None,
         logger: Optional[logging.Logger] = None,
+        bulk_read: bool = False,
+        diagnostics_i2c_addr: Optional[int] = None,
+        diagnostics_history_length: int = 1024,
     ):
+        """
+        If bulk_read is True, the EEPROM is read in a few block reads
+        rather than byte by byte, which also allows all the serial ID fields
+        to be decoded. Some older modules don't support sequential reads
+        so this is off by default.
+
+        Digital diagnostics are read from diagnostics_i2c_addr, which
+        defaults to the address after i2c_addr (i.e. 0x51 for 0x50).
+        The last diagnostics_history_length polls are kept in
+        self.diagnostics_history
+        """
         self.dev = I2CDevice(i2c_bus=i2c_bus, i2c_addr=i2c_addr)
         self.logger = logger if logger else logging.getLogger(__name__)
         self.present = gpio_present
         self.gpio_tx_enable = gpio_tx_enable
         self.gpio_tx_fault = gpio_tx_fault
         self.gpio_los = gpio_los
+        self.bulk_read = bulk_read
+        self.diagnostics_dev = I2CDevice(
+            i2c_bus=i2c_bus,
+            i2c_addr=(
+                diagnostics_i2c_addr
+                if diagnostics_i2c_addr is not None
+                else i2c_addr + 1
+            ),
+        )
+        self.diagnostics_history = RingBuffer(
+            columns=self.DIAGNOSTICS_COLUMNS,
+            capacity=diagnostics_history_length,
+        )
+        self._calibration: Optional[SFPCalibration] = None
 
     def __enter__(self):
         return self
@@ -99,8 +273,10 @@ class SFP:
     def disable_tx(self):
         self.set_tx_enable_state(False)
 
-    def _is_compatible_eeprom(self) -> bool:
-        if self.dev._read8(0) != 3 or self.dev._read8(1) != 4:
+    def _is_compatible_eeprom(self, data: Optional[bytes] = None) -> bool:
+        if data is None:
+            data = bytes([self.dev._read8(0), self.dev._read8(1)])
+        if data[0] != 3 or data[1] != 4:
             # Reg 0 = 3: Connector is SFP (really hope this is true!)
             # Reg 1 = 4: Extended identifier - should be 4 for all SFP modules
             self.logger.error("Incompatible EEPROM found")
@@ -110,11 +286,11 @@ class SFP:
 
     def _read_sfp_type(self) -> str:
         result = self.dev._read8(2)
-        if result == 7:
-            return "LC"
-        else:
+        sfp_type = _decode_sfp_type(result)
+        if sfp_type is None:
             self.logger.warning(f"Unknown SFP Type: {result} found")
             return "Unknown"
+        return sfp_type
 
     def _read_str(self, start_addr: int, end_addr: int) -> str:
         # Reads bytes from start_addr to end_addr inclusive
@@ -133,10 +309,30 @@ class SFP:
     def _read_revision(self) -> str:
         return self._read_str(56, 59)
 
+    def read_eeprom(self) -> bytes:
+        """
+        Returns a snapshot of the whole A0h page, read in a single combined
+        I2C transaction
+        """
+        with self.dev.batch() as batch:
+            page = batch.read_block(0, self.EEPROM_PAGE_LENGTH)
+        return page.result()
+
     def read_sfp_info(self) -> Optional[SFPInfo]:
         if not self.is_present():
             return None
 
+        if self.bulk_read:
+            data = self.read_eeprom()
+            if not self._is_compatible_eeprom(data):
+                return None
+            info = parse_sfp_eeprom(data)
+            if info.sfpType == "Unknown":
+                self.logger.warning(f"Unknown SFP Type: {data[2]} found")
+            if not (info.baseChecksumValid and info.extendedChecksumValid):
+                self.logger.warning("SFP EEPROM checksum mismatch")
+            return info
+
         if not self._is_compatible_eeprom():
             return None
 
@@ -147,6 +343,93 @@ class SFP:
             revision=self._read_revision(),
         )
 
+    def _load_calibration(self) -> SFPCalibration:
+        monitoring_type = self.dev._read8(self.REG_DIAGNOSTIC_MONITORING_TYPE)
+        if not monitoring_type & self.DDM_IMPLEMENTED:
+            raise DiagnosticsNotSupportedError(
+                "SFP module does not implement digital diagnostics"
+            )
+        if monitoring_type & self.DDM_EXTERNALLY_CALIBRATED:
+            self._calibration = parse_sfp_calibration(
+                self.diagnostics_dev._read_block(
+                    self.REG_DDM_CALIBRATION, self.DDM_CALIBRATION_LENGTH
+                )
+            )
+        else:
+            self._calibration = SFPCalibration()
+        return self._calibration
+
+    def poll_diagnostics(self) -> None:
+        """
+        Reads the live diagnostics in a single block read and appends the
+        calibrated values to self.diagnostics_history. The calibration
+        constants are only read on the first poll. Raises
+        DiagnosticsNotSupportedError if the module doesn't implement digital
+        diagnostics
+        """
+        calibration = self._calibration or self._load_calibration()
+        data = self.diagnostics_dev._read_block(
+            self.REG_DDM_MEASUREMENTS, self.DDM_MEASUREMENTS_LENGTH
+        )
+        temperature, vcc, tx_bias, tx_power, rx_power = struct.unpack_from(
+            ">hHHHH", data
+        )
+        r4, r3, r2, r1, r0 = calibration.rxPower
+        self.diagnostics_history.append(
+            (
+                time.time(),
+                # 1/256 degC per LSB
+                (
+                    calibration.temperatureSlope * temperature
+                    + calibration.temperatureOffset
+                )
+                / 256,
+                # 100uV per LSB
+                (calibration.vccSlope * vcc + calibration.vccOffset) * 100e-6,
+                # 2uA per LSB, reported in mA
+                (calibration.txBiasSlope * tx_bias + calibration.txBiasOffset)
+                * 2e-3,
+                # 0.1uW per LSB, reported in mW
+                (
+                    calibration.txPowerSlope * tx_power
+                    + calibration.txPowerOffset
+                )
+                * 1e-4,
+                # Polynomial calibration, 0.1uW per LSB, reported in mW
+                (
+                    (((r4 * rx_power + r3) * rx_power + r2) * rx_power + r1)
+                    * rx_power
+                    + r0
+                )
+                * 1e-4,
+                data[16] << 8 | data[17],
+                data[20] << 8 | data[21],
+            )
+        )
+
+    def read_diagnostics(self) -> SFPDiagnostics:
+        """Polls the diagnostics and returns the new sample"""
+        self.poll_diagnostics()
+        (
+            _,
+            temperature,
+            vcc,
+            tx_bias,
+            tx_power,
+            rx_power,
+            alarms,
+            warnings,
+        ) = self.diagnostics_history.latest()
+        return SFPDiagnostics(
+            temperature=temperature,
+            vcc=vcc,
+            txBias=tx_bias,
+            txPower=tx_power,
+            rxPower=rx_power,
+            alarms=SFPDiagnosticFlag(int(alarms)),
+            warnings=SFPDiagnosticFlag(int(warnings)),
+        )
+
 
 def main():
     with smbus2.SMBus(4) as bus, RPiGPIO(19) as sfp_presentn:
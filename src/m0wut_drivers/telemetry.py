@@ -0,0 +1,484 @@
+from __future__ import annotations
+
+import heapq
+import http.server
+import logging
+import math
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+from m0wut_drivers.histogram import LatencyHistogram
+from m0wut_drivers.ring_buffer import RingBuffer
+
+# A metric source returns the current value of each of its metrics
+MetricReader = Callable[[], dict[str, float]]
+# Called with (source name, timestamp, values) after every successful read
+TelemetryListener = Callable[[str, float, dict[str, float]], None]
+
+
+@dataclass
+class MetricSourceStatistics:
+    runs: int = 0
+    errors: int = 0
+    # Runs which took longer than the source's interval
+    overruns: int = 0
+    # Scheduled reads skipped because the scheduler was behind
+    skipped: int = 0
+    last_duration: Optional[float] = None
+    max_duration: Optional[float] = None
+    # How late each read started compared to its deadline
+    jitter: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+
+@dataclass
+class MetricSource:
+    name: str
+    read: MetricReader
+    interval: float
+    statistics: MetricSourceStatistics = field(
+        default_factory=MetricSourceStatistics
+    )
+
+
+class TelemetryCollector:
+    """
+    Runs metric sources, each at its own interval, from one scheduler
+    thread. Sources are kept in a heap ordered by deadline so the next one
+    due is always run first. Each metric's samples are kept in its own
+    RingBuffer of (time, value), named "<source>_<metric>".
+
+    Sources run one at a time, so a slow source delays the others, which
+    shows up in their jitter statistics. A source taking longer than its
+    interval is counted as an overrun. If the scheduler falls behind,
+    missed reads are skipped rather than run back to back, keeping sources
+    on their original schedule
+    """
+
+    SAMPLE_COLUMNS = ("time", "value")
+    # Minimum time in seconds between overrun warnings for each source
+    OVERRUN_LOG_INTERVAL = 60.0
+
+    def __init__(self, history_length: int = 1024):
+        self.history_length = history_length
+        self.logger = logging.getLogger(__name__)
+        self.sources: dict[str, MetricSource] = {}
+        self.history: dict[str, RingBuffer] = {}
+        self._listeners: list[TelemetryListener] = []
+        # Heap of (deadline, sequence number, source)
+        self._schedule: list[tuple[float, int, MetricSource]] = []
+        # Source name -> (time.monotonic() of the last overrun warning,
+        # overruns since)
+        self._overrun_log: dict[str, tuple[float, int]] = {}
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.stop()
+
+    def add_source(
+        self, name: str, read: MetricReader, interval: float
+    ) -> MetricSource:
+        if interval <= 0:
+            raise ValueError(f"Invalid interval {interval} for {name}")
+        if name in self.sources:
+            raise ValueError(f"Metric source {name} already exists")
+        source = MetricSource(name=name, read=read, interval=interval)
+        with self._condition:
+            self.sources[name] = source
+            self._push(time.monotonic(), source)
+            self._condition.notify()
+        return source
+
+    def remove_source(self, name: str) -> None:
+        with self._condition:
+            source = self.sources.pop(name)
+            self._overrun_log.pop(name, None)
+            self._schedule = [x for x in self._schedule if x[2] is not source]
+            heapq.heapify(self._schedule)
+
+    def add_listener(self, listener: TelemetryListener) -> None:
+        self._listeners.append(listener)
+
+    def _push(self, deadline: float, source: MetricSource) -> None:
+        self._sequence += 1
+        heapq.heappush(self._schedule, (deadline, self._sequence, source))
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="TelemetryCollector", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while self._running:
+                    if self._schedule:
+                        delay = self._schedule[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+                if not self._running:
+                    return
+                deadline, _, source = heapq.heappop(self._schedule)
+            self._run_source(source, deadline)
+            with self._condition:
+                if self.sources.get(source.name) is source:
+                    self._push(self._next_deadline(source, deadline), source)
+
+    def _next_deadline(self, source: MetricSource, deadline: float) -> float:
+        now = time.monotonic()
+        deadline += source.interval
+        if deadline <= now:
+            missed = math.ceil((now - deadline) / source.interval)
+            source.statistics.skipped += missed
+            deadline += missed * source.interval
+        return deadline
+
+    def _run_source(self, source: MetricSource, deadline: float) -> None:
+        statistics = source.statistics
+        start = time.monotonic()
+        statistics.jitter.record(start - deadline)
+        try:
+            values = source.read()
+        except Exception:
+            statistics.errors += 1
+            self.logger.exception(f"Reading metric source {source.name}")
+            return
+        finally:
+            duration = time.monotonic() - start
+            statistics.runs += 1
+            statistics.last_duration = duration
+            if (
+                statistics.max_duration is None
+                or duration > statistics.max_duration
+            ):
+                statistics.max_duration = duration
+            if duration > source.interval:
+                statistics.overruns += 1
+                self._log_overrun(source, duration)
+        timestamp = time.time()
+        self.record(source.name, timestamp, values)
+
+    def _log_overrun(self, source: MetricSource, duration: float) -> None:
+        """Warns about an overrun, at most every OVERRUN_LOG_INTERVAL"""
+        now = time.monotonic()
+        last_log, suppressed = self._overrun_log.get(source.name, (None, 0))
+        if last_log is not None and now - last_log < self.OVERRUN_LOG_INTERVAL:
+            self._overrun_log[source.name] = (last_log, suppressed + 1)
+            return
+        message = (
+            f"Metric source {source.name} took {duration:.3f} s, "
+            f"longer than its {source.interval} s interval"
+        )
+        if suppressed:
+            message += f" ({suppressed} more overruns not logged)"
+        self.logger.warning(message)
+        self._overrun_log[source.name] = (now, 0)
+
+    def record(
+        self, source_name: str, timestamp: float, values: dict[str, float]
+    ) -> None:
+        """Stores samples, e.g. from a source read outside the scheduler"""
+        for metric, value in values.items():
+            name = f"{source_name}_{metric}"
+            buffer = self.history.get(name)
+            if buffer is None:
+                buffer = RingBuffer(self.SAMPLE_COLUMNS, self.history_length)
+                self.history[name] = buffer
+            buffer.append((timestamp, value))
+        for listener in self._listeners:
+            try:
+                listener(source_name, timestamp, values)
+            except Exception:
+                self.logger.exception("Telemetry listener failed")
+
+    def latest(self) -> dict[str, tuple[float, float]]:
+        """Latest (time, value) of every metric"""
+        return {
+            name: buffer.latest()
+            for name, buffer in list(self.history.items())
+            if len(buffer)
+        }
+
+
+class PrometheusExporter:
+    """
+    Serves the latest value of every metric, plus the scheduler statistics,
+    in the Prometheus text exposition format at http://host:port/metrics.
+    The default port avoids node_exporter's 9100, which is often running on
+    the same machine
+    """
+
+    def __init__(
+        self,
+        collector: TelemetryCollector,
+        port: int = 9861,
+        host: str = "127.0.0.1",
+        prefix: str = "m0wut_",
+    ):
+        self.collector = collector
+        self.prefix = prefix
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(
+            target=self.server.serve_forever,
+            name="PrometheusExporter",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    @staticmethod
+    def _metric_name(name: str) -> str:
+        name = re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+        return name if not name[0].isdigit() else f"_{name}"
+
+    @staticmethod
+    def _format_value(value: float) -> str:
+        value = float(value)
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+
+    @staticmethod
+    def _label_value(value: str) -> str:
+        return (
+            value.replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        )
+
+    def render(self) -> str:
+        lines = []
+        for name, (timestamp, value) in sorted(
+            self.collector.latest().items()
+        ):
+            metric = self._metric_name(self.prefix + name)
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(
+                f"{metric} {self._format_value(value)} "
+                f"{int(timestamp * 1000)}"
+            )
+
+        sources = sorted(self.collector.sources.values(), key=lambda x: x.name)
+        for stat in ("runs", "errors", "overruns", "skipped"):
+            metric = f"{self.prefix}telemetry_source_{stat}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for source in sources:
+                label = self._label_value(source.name)
+                lines.append(
+                    f'{metric}{{source="{label}"}} '
+                    f"{getattr(source.statistics, stat)}"
+                )
+        metric = f"{self.prefix}telemetry_source_max_duration_seconds"
+        lines.append(f"# TYPE {metric} gauge")
+        for source in sources:
+            if source.statistics.max_duration is not None:
+                label = self._label_value(source.name)
+                lines.append(
+                    f'{metric}{{source="{label}"}} '
+                    f"{source.statistics.max_duration!r}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+class LineProtocolExporter:
+    """
+    Appends every source read to a file in InfluxDB line protocol, one line
+    per read: <source> <metric>=<value>,... <timestamp in ns>
+    """
+
+    def __init__(self, collector: TelemetryCollector, path: Path):
+        self.file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+        collector.add_listener(self.write)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self.file.close()
+
+    @staticmethod
+    def _escape(name: str) -> str:
+        return (
+            name.replace("\\", "\\\\")
+            .replace(",", "\\,")
+            .replace("=", "\\=")
+            .replace(" ", "\\ ")
+        )
+
+    def write(
+        self, source_name: str, timestamp: float, values: dict[str, float]
+    ) -> None:
+        fields = ",".join(
+            f"{self._escape(metric)}={float(value)!r}"
+            for metric, value in values.items()
+            # Line protocol has no representation for NaN or infinity
+            if math.isfinite(value)
+        )
+        if not fields:
+            return
+        line = f"{self._escape(source_name)} {fields} {int(timestamp * 1e9)}\n"
+        with self._lock:
+            if not self.file.closed:
+                self.file.write(line)
+
+
+def ina3221_metrics(device) -> MetricReader:
+    """Metric source for an INA3221 (one combined read of all channels)"""
+
+    def read() -> dict[str, float]:
+        reading = device.read_all()
+        values = {}
+        for i in range(3):
+            values[f"ch{i + 1}_bus_voltage"] = reading.bus_voltage[i]
+            values[f"ch{i + 1}_current"] = reading.current[i]
+            values[f"ch{i + 1}_power"] = reading.power[i]
+        return values
+
+    return read
+
+
+def sfp_metrics(sfp) -> MetricReader:
+    """Metric source for SFP diagnostics"""
+
+    def read() -> dict[str, float]:
+        diagnostics = sfp.read_diagnostics()
+        return {
+            "temperature": diagnostics.temperature,
+            "vcc": diagnostics.vcc,
+            "tx_bias": diagnostics.txBias,
+            "tx_power": diagnostics.txPower,
+            "rx_power": diagnostics.rxPower,
+            "alarms": int(diagnostics.alarms),
+            "warnings": int(diagnostics.warnings),
+        }
+
+    return read
+
+
+def gps_metrics(monitor) -> MetricReader:
+    """
+    Metric source for a GPSMonitor, best used in watch mode where reads
+    don't query gpsd
+    """
+
+    def read() -> dict[str, float]:
+        packet = monitor.get_current()
+        age = monitor.get_age()
+        return {
+            "mode": packet.mode,
+            "sats": packet.sats,
+            "sats_used": packet.sats_valid,
+            "lat": packet.lat if packet.mode >= 2 else math.nan,
+            "lon": packet.lon if packet.mode >= 2 else math.nan,
+            "alt": packet.alt if packet.mode >= 3 else math.nan,
+            "age": math.nan if age is None else age,
+        }
+
+    return read
+
+
+def system_metrics(monitor) -> MetricReader:
+    """Metric source for a linux_cpu.SystemMonitor"""
+
+    def read() -> dict[str, float]:
+        snapshot = monitor.snapshot()
+        values = {
+            f"{zone}_temperature": temperature
+            for zone, temperature in snapshot.temperatures.items()
+        }
+        values["memory_available"] = snapshot.memory_available
+        values["memory_usage_percent"] = snapshot.memory_usage_percent
+        for interface, speed in snapshot.link_speeds.items():
+            values[f"{interface}_link_speed"] = (
+                math.nan if speed is None else speed
+            )
+        return values
+
+    return read
+
+
+def utilisation_metrics(sampler) -> MetricReader:
+    """Metric source for a linux_cpu.UtilisationSampler"""
+
+    def read() -> dict[str, float]:
+        sample = sampler.sample()
+        values = {"cpu_busy_percent": sample.cpu_busy_percent}
+        for core, busy in enumerate(sample.core_busy_percent):
+            values[f"cpu{core}_busy_percent"] = busy
+        for interface, rates in sample.interfaces.items():
+            for counter in sampler.NET_COUNTERS:
+                values[f"{interface}_{counter}_per_second"] = getattr(
+                    rates, counter
+                )
+        return values
+
+    return read
+
+
+def ds2431_metrics(eeprom) -> MetricReader:
+    """Metric source for the card address in a DS2431"""
+
+    def read() -> dict[str, float]:
+        return {"card_address": eeprom.read_card_address()}
+
+    return read